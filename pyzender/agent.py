@@ -1,23 +1,36 @@
 import configparser
+import hashlib
 import inspect
 import json
 import logging
+import marshal
 import os
 import re
 import shutil
+import signal
 import socket
 import struct
 import subprocess
 import time
 import uuid
+import zlib
 from ast import literal_eval
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import entry_points
 from logging.handlers import RotatingFileHandler
-from threading import Thread
+from threading import Event, Lock, Thread
+from typing import Union
+
+from multiprocessing.connection import wait
 
 from pydantic import BaseModel, Field, ValidationError
 
 from pyzender import modules as pyzender_modules
-from pyzender.modules.base import DiscoveryReport, DataReport, Module
+from pyzender.modules.base import DiscoveryReport, DataReport, Module, TableReport, NS_PER_SECOND, clock
+from pyzender.preprocessing import PreprocessingRule, Preprocessor
+from pyzender.retention import GroupQueue, RetentionPolicy, line_size
+from pyzender.spill import SpillStore
+from pyzender.worker import ModuleWorker
 
 file_handler = RotatingFileHandler(
     filename='/var/log/pyzender.log',
@@ -35,6 +48,25 @@ logging.basicConfig(
 
 logger = logging.getLogger()
 
+# Config file sections that are not modules
+RESERVED_SECTIONS = ("agent", "retention")
+PREPROCESSING_SECTION_PREFIX = "preprocessing "
+
+# Module options that can be changed without restarting the module
+RETUNABLE_OPTIONS = ("data_interval", "discovery_interval")
+
+# A queued line: "- <key> <clock> [<ns>] <value>", the value is quoted or a JSON list of discovery
+QUEUED_LINE = re.compile(r'^(- .+?) (\d+)(?: (\d+))? (".*"|\[.*\])\r\n$', re.DOTALL)
+
+# How long one zabbix_sender run may take
+SENDER_TIMEOUT = 10
+
+# Output of zabbix_sender when the server can't be reached, the portion is sent again later.
+# Other failures (e.g. a malformed line) would repeat forever, so such a portion is dropped.
+SENDER_CONNECTION_ERROR = re.compile(
+    r"cannot connect|connection|timed out|timeout|no route to host|cannot resolve|name or service", re.IGNORECASE
+)
+
 
 def timestamp() -> int:
     return int(time.time())
@@ -50,8 +82,22 @@ class AgentConfig(BaseModel):
                It is configured on the Zabbix Server on the page: "Configuration" > "Hosts".
     zabbix_address - The IP address of the Zabbix Server or Zabbix Proxy.
     sender_path - Path to the zabbix_sender binary
+    sender_workers - Number of queue groups (hosts) that are sent to the server in parallel
+    config_watch_interval - How often the config file is checked for changes. Send SIGHUP to reload it immediately.
+    state_dir - Directory for files that are kept between restarts. The last received active checks are saved there,
+                so modules are started right away even if Zabbix Server is not available.
+    shutdown_timeout - How long the queues are flushed on SIGTERM. Unsent values are saved to state_dir.
+    with_ns - Send nanoseconds of the values (zabbix_sender --with-ns). Changes are applied after restart,
+              saved and spilled values of the previous run are converted.
+    memory_budget - Maximum memory taken by queued items in bytes (0 - unlimited). When it is exceeded, the oldest
+                    low priority items are spilled to "<state_dir>/spill", then bulk items are downsampled,
+                    then items are dropped.
+    spill_limit - Maximum size of spilled items on disk in bytes
+    hosts - Comma separated names of additional hosts served by this agent. Modules for them are received
+            with active checks or configured in "[<module>@<host>]" sections.
     """
     hostname: str = Field(..., pattern=r"^[0-9A-za-z\.\s_-]+$")
+    hosts: str = Field("", pattern=r"^[0-9A-za-z\.\s_,-]*$")
     zabbix_server_host: str
     zabbix_server_port: int = Field(10051, ge=1024, lt=32767)
     zabbix_sender: str = Field(shutil.which("zabbix_sender"))
@@ -60,11 +106,31 @@ class AgentConfig(BaseModel):
     queue_send_size: int = Field(150, ge=1, le=150)
     queue_max_send_interval: int = Field(10, ge=1, le=600)
     modules_sync_interval: int = Field(1, ge=1, le=600)
+    sender_workers: int = Field(1, ge=1, le=64)
+    config_watch_interval: int = Field(5, ge=1, le=600)
+    state_dir: str = Field("/var/lib/pyzender")
+    shutdown_timeout: int = Field(10, ge=1, le=300)
+    with_ns: bool = Field(False)
+    memory_budget: int = Field(0, ge=0)
+    spill_limit: int = Field(1073741824, ge=0)
     debug_mode: bool = Field(False)
     keep_last_items: int = Field(1000, ge=100, le=1000000)
     keep_last_discovery: int = Field(10, ge=10, le=100)
 
 
+def reformat_clock(line: str, with_ns: bool) -> Union[str, None]:
+    """
+    Convert a queued line to the format with or without ns. Returns None if it is not a queued line.
+    """
+    match = QUEUED_LINE.match(line)
+    if not match:
+        return None
+
+    key, seconds, ns, value = match.groups()
+    clock = f"{seconds} {ns or 0}" if with_ns else seconds
+    return f"{key} {clock} {value}\r\n"
+
+
 def configfile_to_dict(config_file, section: str) -> dict:
     dict_ = {opt: config_file.get(section, opt) for opt in config_file.options(section)}
     for key, value in dict_.items():
@@ -74,17 +140,60 @@ def configfile_to_dict(config_file, section: str) -> dict:
     return dict_
 
 
-def find_module_by_name(expected_name: str, **kwargs) -> Module:
-    for name, member in inspect.getmembers(pyzender_modules):
-        if name.lower() == expected_name and issubclass(member, Module):
+def plugin_entry_points() -> list:
+    """
+    Modules provided by third-party packages, registered in the "pyzender.modules" entry point group:
+
+        entry_points={"pyzender.modules": ["mymodule = mypackage.module:MyModule"]}
+    """
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group="pyzender.modules"))
+    return list(eps.get("pyzender.modules", []))
+
+
+def iter_module_classes():
+    for name, member in inspect.getmembers(pyzender_modules, inspect.isclass):
+        if issubclass(member, Module):
+            yield name.lower(), member
+
+    for entry_point in plugin_entry_points():
+        try:
+            member = entry_point.load()
+        except Exception as reason:
+            logger.error(f"Failed to load plugin '{entry_point.name}' from '{entry_point.value}'. {str(reason)}")
+            continue
+
+        if inspect.isclass(member) and issubclass(member, Module):
+            yield entry_point.name.lower(), member
+        else:
+            logger.error(f"Plugin '{entry_point.name}' is not a subclass of pyzender.modules.base.Module")
+
+
+def find_module_by_name(expected_name: str, hostname: str = "default", **kwargs) -> Module:
+    isolated = kwargs.pop("isolated", None)
+    memory_limit = kwargs.pop("memory_limit", 0)
+    cpu_time_limit = kwargs.pop("cpu_time_limit", 0)
+
+    for name, member in iter_module_classes():
+        if name == expected_name:
             logger.info(f"Module with name '{expected_name}' was found, arguments are: {kwargs}")
             try:
-                return member(**kwargs)
+                module = member(**kwargs)
             except ModuleNotFoundError:
                 logger.error(
                     f"Dependencies for module '{expected_name}' are not installed. Install them manually or using "
                     "install.sh script."
                 )
+                return None
+
+            if isolated is not None:
+                module.isolated = bool(int(isolated))
+            module.memory_limit = int(memory_limit)
+            module.cpu_time_limit = int(cpu_time_limit)
+            module.hostname = hostname
+            module.init_kwargs = kwargs
+            return module
 
 
 class Agent:
@@ -94,54 +203,184 @@ class Agent:
         logger.info(f"Starting the agent with UUID: {self.uuid}.")
 
         self.modules = list()
+        self.workers = list()
+        # the config reload and the config sync threads both add, stop and start modules
+        self.modules_lock = Lock()
+        self.sender_pool = None
+        self.sender_pool_size = 0
+        self.config_path = config_path
+        self.config_mtime = self._get_config_mtime()
+        self.reload_event = Event()
+        self.stop_event = Event()
         self._read_config_file(path=config_path)
+        # lines in the queues are formatted with or without ns, so it can't be changed by a reload
+        self.with_ns = self.config.with_ns
 
         self.report_queue = list()
         self.data_queue = {}
         self.discovery_queue = {}
+        self.memory_pressure = False
+        self.spill_store = None
+        if self.config.memory_budget or os.path.isdir(self._spill_dir()):
+            self.spill_store = SpillStore(self._spill_dir(), self.config.spill_limit, self.with_ns, reformat_clock)
 
         self.data_thread = Thread(name="MAIN: Data queue", target=self._data_thread)
         self.discovery_thread = Thread(name="MAIN: Discovery queue", target=self._discovery_thread)
-        self.config_sync_thread = Thread(name="MAIN: Config sync", target=self._config_sync_thread)
+        self.config_sync_thread = Thread(name="MAIN: Config sync", target=self._config_sync_thread, daemon=True)
+        self.config_reload_thread = Thread(
+            name="MAIN: Config reload", target=self._config_reload_thread, daemon=True
+        )
+        self.workers_thread = Thread(name="MAIN: Workers", target=self._workers_thread, daemon=True)
 
         self.sent_total = 0
         self.failed_total = 0
         self.processed_total = 0
         self.last_sent_timestamp = timestamp()
 
-    def _read_config_file(self, path: str):
+        # the last received active checks per host name: {"hash": ..., "data": [...]}
+        self.active_checks = {}
+        self.config_revisions = {}
+        self.synced_checks = {}
+        self._load_active_checks()
+        self._load_queue_snapshot()
+
+    @staticmethod
+    def _load_config_file(path: str) -> tuple:
+        """
+        Parse and validate the config file without touching the running agent.
+        Returns the agent config, the retention policy, the preprocessor and options of every module section.
+        """
         config_file = configparser.ConfigParser(strict=True, empty_lines_in_values=False, allow_no_value=False, )
+        if not config_file.read(path):
+            raise configparser.Error(f"Unable to read {path}")
+
+        config = AgentConfig(**configfile_to_dict(config_file, "agent"))
+        retention = RetentionPolicy(
+            **(configfile_to_dict(config_file, "retention") if config_file.has_section("retention") else {})
+        )
+        preprocessor = Preprocessor([
+            PreprocessingRule(section[len(PREPROCESSING_SECTION_PREFIX):], **configfile_to_dict(config_file, section))
+            for section in config_file.sections() if section.startswith(PREPROCESSING_SECTION_PREFIX)
+        ])
+        module_sections = {
+            section: configfile_to_dict(config_file, section)
+            for section in config_file.sections()
+            if section not in RESERVED_SECTIONS and not section.startswith(PREPROCESSING_SECTION_PREFIX)
+        }
+
+        return config, retention, preprocessor, module_sections
 
+    def _read_config_file(self, path: str):
         logger.info(f"Reading configuration file from: {path}")
         try:
-            config_file.read(path)
             logger.info("Configuration file validation")
-            self.config = AgentConfig(**configfile_to_dict(config_file, "agent"))
-            for section in config_file.sections():
-                module_kwargs = configfile_to_dict(config_file, section)
-                module = find_module_by_name(section, **module_kwargs)
-                if module:
-                    self.modules.append(module)
+            self.config, self.retention, self.preprocessor, self.module_sections = self._load_config_file(path)
+            self.configured_modules = {}
+            for section, module_kwargs in self.module_sections.items():
+                self._create_module(section, module_kwargs)
 
         except configparser.Error as reason:
             logger.critical(f"Failed to read the config file! {str(reason)}")
             self.kill(str(reason))
 
-        except ValidationError as reason:
+        except (ValidationError, TypeError, ValueError, re.error) as reason:
             logger.critical(f"Validation failed! {str(reason)}")
             self.kill(str(reason))
 
         else:
             logger.info("Configuration file is valid and successfully initialized")
 
-    def _send_data(self, this_is_a_data_queue: bool = False):
+    def _create_module(self, section: str, module_kwargs: dict) -> None:
+        # "[qbittorrent@seedbox]" configures a module for another host
+        module_name, _, hostname = section.partition("@")
+        module = find_module_by_name(module_name, hostname=hostname or "default", **module_kwargs)
+        if module:
+            self.modules.append(module)
+            self.configured_modules[section] = module
+
+    def _get_config_mtime(self) -> float:
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError:
+            return 0.0
+
+    def reload_config(self) -> None:
+        """
+        Apply a changed config file. Queues are kept, only modules with changed sections are restarted.
+        """
+        logger.info(f"Reloading configuration file from: {self.config_path}")
+        try:
+            config, retention, preprocessor, module_sections = self._load_config_file(self.config_path)
+        except (configparser.Error, ValidationError, TypeError, ValueError, re.error) as reason:
+            logger.error(f"The new config file is not valid, keeping the current configuration. {str(reason)}")
+            return
+
+        self.config = config
+        self.retention = retention
+        self.preprocessor = preprocessor
+
+        with self.modules_lock:
+            for section in set(self.module_sections) | set(module_sections):
+                old_kwargs = self.module_sections.get(section)
+                new_kwargs = module_sections.get(section)
+                if old_kwargs == new_kwargs:
+                    continue
+
+                module = self.configured_modules.pop(section, None)
+                changed_options = {
+                    option for option in set(old_kwargs or {}) | set(new_kwargs or {})
+                    if (old_kwargs or {}).get(option) != (new_kwargs or {}).get(option)
+                }
+
+                if module and new_kwargs and changed_options.issubset(RETUNABLE_OPTIONS) and not module.isolated:
+                    logger.info(f"Retuning '{section}' module: {new_kwargs}")
+                    module.data_interval = float(new_kwargs.get("data_interval", module.data_interval))
+                    module.discovery_interval = float(new_kwargs.get("discovery_interval", module.discovery_interval))
+                    self.configured_modules[section] = module
+                    continue
+
+                if module:
+                    logger.info(f"Stopping '{section}' module")
+                    self._stop_module(module)
+
+                if new_kwargs is not None:
+                    # the same module could be already started with active checks, the configured one replaces it
+                    module_name, _, hostname = section.partition("@")
+                    hostname = hostname or "default"
+                    for running in [m for m in self.modules if m.name == module_name and m.hostname == hostname]:
+                        logger.info(f"Replacing '{section}' module started with active checks by the configured one")
+                        self._stop_module(running)
+
+                    try:
+                        self._create_module(section, new_kwargs)
+                    except (TypeError, ValueError, re.error) as reason:
+                        logger.error(f"Failed to create '{section}' module. {str(reason)}")
+
+            self.module_sections = module_sections
+            # modules could be recreated, so active checks are applied again on the next sync
+            self.synced_checks.clear()
+            self._start_all_modules()
+        logger.info("Configuration file has been reloaded")
+
+    def _stop_module(self, module: Module) -> None:
+        for worker in list(self.workers):
+            if worker.module is module:
+                worker.stop()
+                self.workers.remove(worker)
+
+        module.stop()
+        self.modules.remove(module)
+
+    def _send_data(self, this_is_a_data_queue: bool = False, flush: bool = False, deadline: float = None):
         """
-        Communicate with Zabbix Sender process (up to 150 values in one connection)
+        Communicate with Zabbix Sender process (up to 150 values in one connection).
+        With sender_workers > 1 the groups are split into shards that are sent in parallel.
+        flush - Send all groups regardless of their size, until the deadline (time.monotonic()) is reached
         """
         queue = self.data_queue if this_is_a_data_queue else self.discovery_queue
         limit = self.config.keep_last_items if this_is_a_data_queue else self.config.keep_last_discovery
 
-        timeout_reached = (timestamp() - self.last_sent_timestamp) >= self.config.queue_max_send_interval
+        timeout_reached = flush or (timestamp() - self.last_sent_timestamp) >= self.config.queue_max_send_interval
         if timeout_reached:
             self.last_sent_timestamp = timestamp()
 
@@ -153,59 +392,31 @@ class Agent:
                 f" and {items_in_queue} items in the queue."
             )
 
-        processed = failed = sent = 0
-
-        for group, data_lines in queue.items():
+        groups_to_send = []
+        for group, data_lines in list(queue.items()):
             this_is_a_discovery_queue = not this_is_a_data_queue
             data_queue_is_full_enough = len(data_lines) >= self.config.queue_send_size
             it_has_at_least_one_item = len(data_lines) > 0
 
             if data_queue_is_full_enough or timeout_reached or (
                     it_has_at_least_one_item and this_is_a_discovery_queue):
-                # Send data to the server until there is nothing left to send in this group
-                while len(data_lines) > 0:
-                    try:
-                        sender_subprocess = subprocess.Popen(
-                            self._get_sender_args(*group.split("@")),
-                            stdout=subprocess.PIPE,
-                            stdin=subprocess.PIPE
-                        )
-                    except (OSError, ValueError) as reason:
-                        logger.error(f"Unable to open Zabbix Sender process. {str(reason)}")
-                    else:
-                        data_portion = []
-                        while len(data_lines) > 0 and len(data_portion) < self.config.queue_send_size:
-                            data_portion.append(data_lines.pop(0))
-
-                        sender_data = "".join(data_portion)
-                        try:
-                            stdout, _ = sender_subprocess.communicate(bytes(sender_data, "UTF-8"), timeout=10)
-                        except (subprocess.TimeoutExpired, OSError) as message:
-                            logger.error(str(message))
-                            data_lines += data_portion
-                        else:
-                            if self.config.debug_mode:
-                                logger.debug(f"Sending data to the {group} host: \n{sender_data}")
-
-                            re_search_stdout = re.search(
-                                pattern="processed:\s(\d+);\sfailed:\s(\d+);.*sent:\s(\d+);",
-                                string=str(stdout)
-                            )
-
-                            if re_search_stdout:
-                                processed += int(re_search_stdout.group(1))
-                                failed += int(re_search_stdout.group(2))
-                                sent += int(re_search_stdout.group(3))
-
-                            if re.search(pattern="warning", string=str(stdout), flags=re.IGNORECASE):
-                                logger.warning(str(stdout))
-
-                        sender_subprocess.kill()
-
-            # Delete old data that exceeds the limit
+                groups_to_send.append((group, data_lines))
+
+        shards = self._shard_groups(groups_to_send)
+        if len(shards) > 1:
+            results = list(self._get_sender_pool().map(self._send_shard, shards, [deadline] * len(shards)))
+        else:
+            results = [self._send_shard(shard, deadline) for shard in shards]
+
+        processed = sum([r[0] for r in results])
+        failed = sum([r[1] for r in results])
+        sent = sum([r[2] for r in results])
+
+        for group, data_lines in list(queue.items()):
+            # Delete old data that exceeds the limit, low priority first
             if len(data_lines) > limit:
                 diff = len(data_lines) - limit
-                del data_lines[0:diff]
+                data_lines.evict(diff)
 
         self.processed_total += processed
         self.failed_total += failed
@@ -219,13 +430,128 @@ class Agent:
                 f" The next turn will be in {self.config.queue_lookup_interval} seconds"
             )
 
-    def _request_active_checks(self) -> list:
+    def _get_sender_pool(self) -> ThreadPoolExecutor:
+        if self.sender_pool_size != self.config.sender_workers:
+            if self.sender_pool:
+                self.sender_pool.shutdown(wait=False)
+            self.sender_pool_size = self.config.sender_workers
+            self.sender_pool = ThreadPoolExecutor(
+                max_workers=self.config.sender_workers,
+                thread_name_prefix="MAIN: Sender",
+            )
+
+        return self.sender_pool
+
+    def _shard_groups(self, groups: list) -> list:
+        """
+        A group always lands in the same shard, so its lines are never sent by two workers at once
+        """
+        shards = [[] for _ in range(min(self.config.sender_workers, len(groups)))]
+        for group, data_lines in groups:
+            shards[zlib.crc32(group.encode()) % len(shards)].append((group, data_lines))
+
+        return [shard for shard in shards if shard]
+
+    def _send_shard(self, shard: list, deadline: float = None) -> tuple:
+        processed = failed = sent = 0
+        for group, data_lines in shard:
+            result = self._send_group(group, data_lines, deadline)
+            processed += result[0]
+            failed += result[1]
+            sent += result[2]
+
+        return processed, failed, sent
+
+    def _send_group(self, group: str, data_lines: GroupQueue, deadline: float = None) -> tuple:
+        """
+        Send data to the server until there is nothing left to send in this group. Critical items go first.
+        A regular turn (without a deadline) stops when the agent is stopping, the rest is flushed by shutdown().
+        """
+        processed = failed = sent = 0
+
+        while len(data_lines) > 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if deadline is None and self.stop_event.is_set():
+                break
+
+            try:
+                sender_subprocess = subprocess.Popen(
+                    self._get_sender_args(*group.split("@")),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    stdin=subprocess.PIPE
+                )
+            except (OSError, ValueError) as reason:
+                logger.error(f"Unable to open Zabbix Sender process. {str(reason)}")
+                break
+
+            data_portion = data_lines.take(self.config.queue_send_size)
+
+            sender_data = "".join([line for _, line in data_portion])
+            try:
+                stdout, stderr = sender_subprocess.communicate(bytes(sender_data, "UTF-8"), timeout=SENDER_TIMEOUT)
+            except (subprocess.TimeoutExpired, OSError) as message:
+                logger.error(str(message))
+                data_lines.put_back(data_portion)
+                sender_subprocess.kill()
+                # the server is not responding, the rest will be sent on the next turn
+                break
+
+            if self.config.debug_mode:
+                logger.debug(f"Sending data to the {group} host: \n{sender_data}")
+
+            re_search_stdout = re.search(
+                pattern="processed:\s(\d+);\sfailed:\s(\d+);.*sent:\s(\d+);",
+                string=str(stdout)
+            )
+
+            if sender_subprocess.returncode == 1 and not (re_search_stdout and int(re_search_stdout.group(3))):
+                output = (stdout + stderr).decode("utf-8", errors="replace")
+                if SENDER_CONNECTION_ERROR.search(output):
+                    logger.error(f"Zabbix Sender failed to connect to the server for the {group} host. {output}")
+                    data_lines.put_back(data_portion)
+                    # the server is not available, the rest will be sent on the next turn
+                    break
+
+                logger.error(
+                    f"Zabbix Sender rejected {len(data_portion)} items for the {group} host, they are dropped."
+                    f" {output}\n{sender_data}"
+                )
+                sender_subprocess.kill()
+                continue
+
+            if re_search_stdout:
+                processed += int(re_search_stdout.group(1))
+                failed += int(re_search_stdout.group(2))
+                sent += int(re_search_stdout.group(3))
+
+            if re.search(pattern="warning", string=str(stdout), flags=re.IGNORECASE):
+                logger.warning(str(stdout))
+
+            sender_subprocess.kill()
+
+        return processed, failed, sent
+
+    def _host_name(self, hostname: str) -> str:
+        return self.config.hostname if hostname == "default" else hostname
+
+    def _request_active_checks(self, hostname: str = "default") -> Union[list, None]:
+        """
+        Returns None if the request has failed or the server has nothing new since the previous request
+        """
+        hostname = self._host_name(hostname)
+
         address = (self.config.zabbix_server_host, self.config.zabbix_server_port)
-        logger.info(f"Requesting a list of active checks from {address[0]}:{address[1]}")
+        logger.info(f"Requesting a list of active checks for '{hostname}' from {address[0]}:{address[1]}")
         data = {
             "request": "active checks",
-            "host": self.config.hostname,
+            "host": hostname,
+            "session": self.uuid.hex,
         }
+        # Zabbix Server 6.4+ doesn't send the list again if the configuration revision of the session is the same
+        if hostname in self.config_revisions and hostname in self.active_checks:
+            data["config_revision"] = self.config_revisions[hostname]
         utf8_encoded_json = json.dumps(data).encode('utf-8')
         zbx_header = b'ZBXD' + struct.pack("<BII", 0x01, len(utf8_encoded_json), 0)
 
@@ -255,19 +581,97 @@ class Agent:
             decoded_data = literal_eval(raw_data.decode('utf-8'))
             if decoded_data != {} and decoded_data["response"] == "success" and "data" in decoded_data.keys():
                 logger.info(f"Success! The next request will be in {self.config.modules_sync_interval} seconds")
+                if "config_revision" in decoded_data:
+                    self.config_revisions[hostname] = decoded_data["config_revision"]
                 return decoded_data["data"]
+            elif decoded_data != {} and decoded_data["response"] == "success" and hostname in self.active_checks:
+                logger.info(f"Active checks for '{hostname}' are not changed")
+                return None
             elif decoded_data['response'] == 'failed':
                 raise PyzenderError(decoded_data["info"])
             else:
                 raise PyzenderError('Unsupported response from Zabbix Server')
 
-        except (OSError, PyzenderError) as reason:
-            logger.error(f"Failed to receive active checks from Zabbix Server. {str(reason)}")
-            return []
+        except (OSError, ValueError, SyntaxError, KeyError, PyzenderError) as reason:
+            logger.error(f"Failed to receive active checks for '{hostname}' from Zabbix Server. {str(reason)}")
+            self.config_revisions.pop(hostname, None)
+            return None
+
+    @staticmethod
+    def _hash_active_checks(active_checks: list) -> str:
+        return hashlib.sha256(json.dumps(active_checks, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _active_checks_path(self) -> str:
+        return os.path.join(self.config.state_dir, "active_checks.json")
+
+    def _load_active_checks(self) -> None:
+        path = self._active_checks_path()
+        try:
+            with open(path) as active_checks_file:
+                cached_checks = json.load(active_checks_file)
+            if not isinstance(cached_checks, dict):
+                raise ValueError("Unexpected format")
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as reason:
+            logger.error(f"Failed to load active checks from {path}. {str(reason)}")
+            return
+
+        for hostname, cached in cached_checks.items():
+            if not isinstance(cached, dict) or self._hash_active_checks(cached.get("data")) != cached.get("hash"):
+                logger.warning(f"Saved active checks for '{hostname}' are corrupted, ignoring them")
+                continue
+            self.active_checks[hostname] = cached
+
+        logger.info(f"Active checks for {len(self.active_checks)} hosts were loaded from {path}")
+
+    def _save_active_checks(self) -> None:
+        path = self._active_checks_path()
+        try:
+            os.makedirs(self.config.state_dir, exist_ok=True)
+            with open(f"{path}.tmp", "w") as active_checks_file:
+                json.dump(self.active_checks, active_checks_file)
+            os.replace(f"{path}.tmp", path)
+        except OSError as reason:
+            logger.error(f"Failed to save active checks to {path}. {str(reason)}")
 
     def _sync_modules(self) -> None:
         logger.info("Starting to sync module configurations")
-        active_checks = self._request_active_checks()
+        hosts = self.hosts()
+        with ThreadPoolExecutor(max_workers=min(16, len(hosts)), thread_name_prefix="MAIN: Config sync") as pool:
+            active_checks_per_host = list(pool.map(self._request_active_checks, hosts))
+
+        changed = False
+        for hostname, active_checks in zip(hosts, active_checks_per_host):
+            if active_checks is None:
+                continue
+            checks_hash = self._hash_active_checks(active_checks)
+            cached = self.active_checks.get(self._host_name(hostname))
+            if cached is None or cached["hash"] != checks_hash:
+                self.active_checks[self._host_name(hostname)] = {"hash": checks_hash, "data": active_checks}
+                changed = True
+
+        if changed:
+            self._save_active_checks()
+
+        self._apply_active_checks(hosts)
+
+    def _apply_active_checks(self, hosts: list) -> None:
+        """
+        Walk the last received active checks of every host, unless they were already applied, and start new modules.
+        If the server is not available, the checks saved by the previous run are used.
+        """
+        with self.modules_lock:
+            for hostname in hosts:
+                cached = self.active_checks.get(self._host_name(hostname))
+                if cached is None or self.synced_checks.get(hostname) == cached["hash"]:
+                    continue
+                self._sync_host_modules(hostname, cached["data"])
+                self.synced_checks[hostname] = cached["hash"]
+
+            self._start_all_modules()
+
+    def _sync_host_modules(self, hostname: str, active_checks: list) -> None:
         # discovered_modules = set()
 
         for active_check in active_checks:
@@ -280,9 +684,14 @@ class Agent:
                 # discovered_modules.add(module_name)
 
                 # add a new module and feed an argument to it
-                if module_name not in self.active_modules():
-                    logger.info(f"Received a new module name from the server: '{module_name}'")
-                    new_module = find_module_by_name(module_name, **{param_name: param_value})
+                if (module_name, hostname) not in self.active_modules():
+                    logger.info(f"Received a new module name from the server: '{module_name}' for '{hostname}'")
+                    try:
+                        new_module = find_module_by_name(module_name, hostname=hostname, **{param_name: param_value})
+                    except (TypeError, ValueError, re.error) as reason:
+                        logger.error(f"Failed to create '{module_name}' module for '{hostname}'. {str(reason)}")
+                        continue
+
                     if new_module:
                         self.modules.append(new_module)
                     else:
@@ -294,28 +703,35 @@ class Agent:
                 # update an argument for an existing module
                 else:
                     for module in self.modules:
-                        if module.name == module_name:
+                        if module.name == module_name and module.hostname == hostname:
                             module.config[param_name] = param_value
                             break
 
-        self._start_all_modules()
-
     def _start_all_modules(self):
         for module in self.modules:
             if not module.running:
                 logger.info(f"Seems that '{module.name}' module is not running. Trying to start it")
-                module.run(agent=self)
+                if module.isolated:
+                    self._start_worker(module)
+                else:
+                    module.run(agent=self)
+
+    def _start_worker(self, module: Module):
+        worker = ModuleWorker(module, memory_limit=module.memory_limit, cpu_time_limit=module.cpu_time_limit)
+        worker.start()
+        module.agent = self
+        module.running = True
+        self.workers.append(worker)
 
     def _data_thread(self) -> None:
         logger.info(f"Starting thread for sending items data.")
-        while True:
-            time.sleep(self.config.queue_lookup_interval)
+        while not self.stop_event.wait(self.config.queue_lookup_interval):
             self._send_data(this_is_a_data_queue=True)
+            self._enforce_memory_budget()
 
     def _discovery_thread(self) -> None:
         logger.info(f"Starting thread for sending discovery events.")
-        while True:
-            time.sleep(self.config.queue_lookup_interval)
+        while not self.stop_event.wait(self.config.queue_lookup_interval):
             self._send_data()
 
     def _config_sync_thread(self) -> None:
@@ -324,13 +740,37 @@ class Agent:
             time.sleep(self.config.modules_sync_interval)
             self._sync_modules()
 
+    def _config_reload_thread(self) -> None:
+        logger.info("Starting thread for config file reloading.")
+        while True:
+            reload_requested = self.reload_event.wait(timeout=self.config.config_watch_interval)
+            self.reload_event.clear()
+
+            mtime = self._get_config_mtime()
+            if reload_requested or mtime != self.config_mtime:
+                self.config_mtime = mtime
+                self.reload_config()
+
+    def _workers_thread(self) -> None:
+        logger.info("Starting thread for supervising module worker processes.")
+        while not self.stop_event.is_set():
+            connections = [worker.connection for worker in self.workers if worker.connection]
+            if connections:
+                wait(connections, timeout=1)
+            else:
+                time.sleep(1)
+
+            for worker in list(self.workers):
+                worker.collect(self.report_queue)
+                worker.supervise()
+
     def _update_discovery_queue(self, report: DiscoveryReport):
         group = f"{report.hostname}@{report.server}:{report.port}"
         if group not in self.discovery_queue.keys():
-            self.discovery_queue.update({group: []})
+            self.discovery_queue.update({group: GroupQueue()})
 
         value_in_json = json.dumps([{report.macros: value} for value in report.values])
-        line = f'- {report.key} {report.timestamp} {value_in_json}\r\n'
+        line = f'- {report.key} {self._format_clock(report)} {value_in_json}\r\n'
         self.discovery_queue[group].append(line)
 
     def _update_data_queue(
@@ -341,9 +781,12 @@ class Agent:
     ):
         group = f"{report.hostname}@{report.server}:{report.port}"
         if group not in self.data_queue.keys():
-            self.data_queue.update({group: list()})
+            self.data_queue.update({group: GroupQueue()})
 
         dict_ = recursive_dict or report.items
+        data_lines = self.data_queue[group]
+        report_clock = self._format_clock(report)
+        report_time = report.timestamp + report.ns / NS_PER_SECOND
 
         for dict_key, value in dict_.items():
             if value is None:
@@ -354,15 +797,61 @@ class Agent:
             else:
                 key_path = ".".join([recursive_key_path, dict_key])
 
+            full_key_path = ".".join([key_path, report.append_key]) if report.append_key else key_path
+            if not self._preprocess(data_lines, full_key_path, report_time, report_clock, value):
+                continue
+
             if isinstance(value, dict):
                 self._update_data_queue(report=report, recursive_dict=value, recursive_key_path=key_path)
 
             else:
-                if report.append_key:
-                    key_path = ".".join([key_path, report.append_key])
+                self._append_data_line(data_lines, full_key_path, report_clock, value)
+
+    def _update_table_queue(self, report: TableReport):
+        group = f"{report.hostname}@{report.server}:{report.port}"
+        if group not in self.data_queue.keys():
+            self.data_queue.update({group: GroupQueue()})
+
+        data_lines = self.data_queue[group]
+        report_clock = self._format_clock(report)
+        report_time = report.timestamp + report.ns / NS_PER_SECOND
+        for column, values in report.columns.items():
+            prefix = f"{report.key}.{column}."
+            for instance, value in zip(report.instances, values):
+                key_path = prefix + instance
+                if value is not None and self._preprocess(data_lines, key_path, report_time, report_clock, value):
+                    self._append_data_line(data_lines, key_path, report_clock, value)
+
+    def _format_clock(self, report: Union[DataReport, TableReport, DiscoveryReport]) -> str:
+        if self.with_ns:
+            return f"{report.timestamp} {report.ns}"
+        return str(report.timestamp)
+
+    def _preprocess(self, data_lines: GroupQueue, key_path: str, report_time: float, report_clock: str, value) -> bool:
+        """
+        Enqueue values produced by preprocessing rules. Returns False if the original value must not be sent.
+        """
+        processed = self.preprocessor.process(key_path, value, report_time)
+        if processed is None:
+            return True
+
+        results, keep_original = processed
+        for result_key_path, result in results:
+            self._append_data_line(data_lines, result_key_path, report_clock, result)
+
+        # a rule that produced nothing for a dict, e.g. "multiplier" that matches a parent key, doesn't hide its items
+        if isinstance(value, dict) and not results:
+            return True
 
-                line = f'- {key_path} {report.timestamp} "{value}"\r\n'
-                self.data_queue[group].append(line)
+        return keep_original
+
+    def _append_data_line(self, data_lines: GroupQueue, key_path: str, report_clock: str, value) -> None:
+        priority = self.retention.classify(key_path)
+        queue_is_full = self.memory_pressure or len(data_lines) >= self.config.keep_last_items
+        if self.retention.keep(key_path, priority, queue_is_full):
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\r", "\\r").replace("\n", "\\n")
+            line = f'- {key_path} {report_clock} "{value}"\r\n'
+            data_lines.append(line, priority)
 
     def _get_sender_args(self, hostname: str, server: str) -> list:
         if hostname == "default":
@@ -381,6 +870,7 @@ class Agent:
             "--host", hostname,
             "--port", str(port),
             "--with-timestamps",
+            *(["--with-ns"] if self.with_ns else []),
             "--verbose",
             "--input-file", "-",
         ]
@@ -392,22 +882,209 @@ class Agent:
         return sum([len(lines) for _, lines in self.discovery_queue.items()])
 
     def active_modules(self) -> set:
-        return set(m.name for m in self.modules)
+        return set((m.name, m.hostname) for m in self.modules)
+
+    def hosts(self) -> list:
+        """
+        All hosts served by the agent, "default" is the host from the "hostname" option
+        """
+        hosts = ["default"]
+        extra_hosts = [h.strip() for h in self.config.hosts.split(",")] + [m.hostname for m in self.modules]
+        for hostname in extra_hosts:
+            if hostname and hostname != self.config.hostname and hostname not in hosts:
+                hosts.append(hostname)
+
+        return hosts
+
+    def _process_report_queue(self) -> None:
+        while len(self.report_queue) > 0:
+            report = self.report_queue.pop(0)
+            if report.timestamp is None:
+                report.timestamp, report.ns = clock()
+
+            if isinstance(report, DataReport):
+                self._update_data_queue(report)
+            elif isinstance(report, TableReport):
+                self._update_table_queue(report)
+            elif isinstance(report, DiscoveryReport):
+                self._update_discovery_queue(report)
+
+    def _spill_dir(self) -> str:
+        return os.path.join(self.config.state_dir, "spill")
+
+    def _enforce_memory_budget(self) -> None:
+        """
+        Keep queued items under memory_budget: spill them to disk first, then downsample bulk keys, then drop.
+        Spilled items are restored when there is enough room again.
+        """
+        budget = self.config.memory_budget
+        if budget and self.spill_store is None:
+            self.spill_store = SpillStore(self._spill_dir(), self.config.spill_limit, self.with_ns, reformat_clock)
+        if self.spill_store:
+            self.spill_store.limit = self.config.spill_limit
+
+        used = self.queued_bytes()
+        groups = sorted(self.data_queue.items(), key=lambda item: item[1].size, reverse=True)
+
+        if budget and used > budget:
+            target = int(budget * 0.8)
+            for group, data_lines in groups:
+                if used <= target or not self.spill_store.has_room():
+                    break
+                portion = data_lines.take_lowest(used - target)
+                if not self.spill_store.spill(group, portion):
+                    data_lines.put_back(portion)
+                    break
+                used -= sum([line_size(line) for _, line in portion])
+                logger.warning(f"Memory budget is exceeded, {len(portion)} items of {group} were spilled to disk")
+
+            # downsampling takes effect for new items, what is still over the budget is dropped
+            self.memory_pressure = used > target
+            for group, data_lines in groups:
+                if used <= budget:
+                    break
+                before = data_lines.size
+                data_lines.evict(size=used - budget)
+                used -= before - data_lines.size
+                logger.warning(f"Memory budget is exceeded, {before - data_lines.size} bytes of {group} were dropped")
+
+        else:
+            self.memory_pressure = False
+            room = (budget // 2 - used) if budget else self.config.queue_send_size * 1024
+            restore_groups = self.spill_store.groups_to_restore() if self.spill_store else []
+            for group in restore_groups:
+                if room <= 0:
+                    break
+                portion = self.spill_store.restore(group, room // len(restore_groups))
+                self.data_queue.setdefault(group, GroupQueue()).put_back(portion)
+                room -= sum([line_size(line) for _, line in portion])
+
+    def queued_bytes(self) -> int:
+        return sum([lines.size for lines in list(self.data_queue.values()) + list(self.discovery_queue.values())])
+
+    def spilled_bytes(self) -> int:
+        return self.spill_store.size() if self.spill_store else 0
+
+    @staticmethod
+    def rss_bytes() -> int:
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.config.state_dir, "queue.snapshot")
+
+    def _save_queue_snapshot(self) -> None:
+        """
+        Save unsent values as a zlib compressed marshal dump of (priority, line) pairs per group
+        """
+        snapshot = {
+            "with_ns": self.with_ns,
+            "data": {group: lines.take(len(lines)) for group, lines in self.data_queue.items() if len(lines)},
+            "discovery": {group: lines.take(len(lines)) for group, lines in self.discovery_queue.items() if len(lines)},
+        }
+        items = sum([len(pairs) for name in ("data", "discovery") for pairs in snapshot[name].values()])
+        if not items:
+            return
+
+        path = self._snapshot_path()
+        try:
+            with open(f"{path}.tmp", "wb") as snapshot_file:
+                snapshot_file.write(zlib.compress(marshal.dumps(snapshot)))
+            os.replace(f"{path}.tmp", path)
+        except OSError as reason:
+            logger.error(f"Failed to save {items} unsent items to {path}. {str(reason)}")
+        else:
+            logger.info(f"{items} unsent items were saved to {path}")
+
+    def _load_queue_snapshot(self) -> None:
+        path = self._snapshot_path()
+        try:
+            with open(path, "rb") as snapshot_file:
+                snapshot = marshal.loads(zlib.decompress(snapshot_file.read()))
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, EOFError, TypeError, zlib.error) as reason:
+            logger.error(f"Failed to load unsent items from {path}. {str(reason)}")
+            return
+
+        # lines were formatted for the with_ns option of the previous run
+        reformat = snapshot.get("with_ns") != self.with_ns
+        items = dropped = 0
+        for queue_name, queue in (("data", self.data_queue), ("discovery", self.discovery_queue)):
+            for group, pairs in snapshot.get(queue_name, {}).items():
+                lines = queue.setdefault(group, GroupQueue())
+                for priority, line in pairs:
+                    if reformat:
+                        line = reformat_clock(line, self.with_ns)
+                        if line is None:
+                            dropped += 1
+                            continue
+                    lines.append(line, priority)
+                    items += 1
+
+        logger.info(f"{items} unsent items were loaded from {path}")
+        if dropped:
+            logger.warning(f"{dropped} unsent items from {path} were dropped, they can't be converted for with_ns")
+
+    def stop(self, signum: int = signal.SIGTERM, frame=None) -> None:
+        logger.info(f"Received signal {signum}, stopping the agent")
+        self.stop_event.set()
+
+    def shutdown(self) -> None:
+        """
+        Stop collecting, flush the queues until shutdown_timeout and save everything that is left
+        """
+        deadline = time.monotonic() + self.config.shutdown_timeout
+
+        for worker in list(self.workers):
+            worker.collect(self.report_queue)
+            worker.stop()
+        with self.modules_lock:
+            for module in self.modules:
+                module.stop()
+
+        self._process_report_queue()
+
+        # let the sending threads finish the portion in flight, so no group is sent twice at once
+        # and a portion that is put back after a failure isn't missed by the snapshot
+        for thread in (self.data_thread, self.discovery_thread):
+            if thread.is_alive():
+                thread.join(timeout=max(deadline - time.monotonic(), SENDER_TIMEOUT))
+
+        logger.info(f"Flushing {self.data_queue_size()} items and {self.discovery_queue_size()} discovery events")
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="MAIN: Flush") as pool:
+            pool.submit(self._send_data, this_is_a_data_queue=True, flush=True, deadline=deadline)
+            pool.submit(self._send_data, flush=True, deadline=deadline)
+
+        self._save_queue_snapshot()
+        if self.spill_store:
+            self.spill_store.compact()
+        if self.sender_pool:
+            self.sender_pool.shutdown(wait=False)
+        logger.info("The agent has been stopped")
 
     def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_event.set())
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        # start configured modules and modules from the saved active checks without waiting for the server
+        self._apply_active_checks(self.hosts())
+
         self.config_sync_thread.start()
+        self.config_reload_thread.start()
         self.data_thread.start()
         self.discovery_thread.start()
+        self.workers_thread.start()
 
-        while True:
-            time.sleep(self.config.queue_update_interval)
-
-            while len(self.report_queue) > 0:
-                report = self.report_queue.pop(0)
-                if isinstance(report, DataReport):
-                    self._update_data_queue(report)
-                elif isinstance(report, DiscoveryReport):
-                    self._update_discovery_queue(report)
+        while not self.stop_event.wait(self.config.queue_update_interval):
+            self._process_report_queue()
+
+        self.shutdown()
 
     @staticmethod
     def kill(reason: str = "", signal: int = 9):
@@ -1,3 +1,6 @@
 from .agent_stats import AgentStats
 from .psutil import PSUtil
 from .qbit import QBittorrent
+from .processes import Processes
+from .logtail import LogTail
+from .cgroups import CGroups
@@ -18,9 +18,14 @@ class AgentStats(Module):
                 "queue": sum(
                     [len(data_lines) for _, data_lines in self.agent.data_queue.items()]
                     + [len(data_lines) for _, data_lines in self.agent.discovery_queue.items()]
-                )
+                ),
+                "memory": {
+                    "queue_bytes": self.agent.queued_bytes(),
+                    "spilled_bytes": self.agent.spilled_bytes(),
+                    "rss": self.agent.rss_bytes(),
+                    "pressure": int(self.agent.memory_pressure),
+                },
             },
             key="pyzender",
-            timestamp=self.timestamp(),
         )
         self._report(health)
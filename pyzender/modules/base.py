@@ -1,32 +1,76 @@
 import logging
 import time
 from abc import ABC, abstractmethod
-from threading import Thread
-from typing import List, Union
+from threading import Event, Thread, local
+from typing import Dict, List, Tuple, Union
 
 logger = logging.getLogger()
 
+NS_PER_SECOND = 1000000000
+
+
+def clock() -> Tuple[int, int]:
+    """
+    Current time as (seconds, nanoseconds), the "clock" and "ns" fields of the Zabbix protocol.
+    Modules read it once per collection, so all values of one collection share the same clock.
+    """
+    return divmod(time.time_ns(), NS_PER_SECOND)
+
 
 class DataReport:
     def __init__(
             self,
             items: dict,
             key: str,
-            timestamp: int = int(time.time()),
+            timestamp: int = None,
             append_key: str = "",
             hostname: str = "default",
             port: str = "default",
-            server: str = "default"
+            server: str = "default",
+            ns: int = 0,
     ):
+        """
+        timestamp - Clock of the values. When it is not set, the clock of the current collection is used.
+        """
         self.items = items
         self.key = key.replace(" ", "_")
         self.timestamp = timestamp
+        self.ns = ns
         self.append_key = append_key.replace(" ", "_")
         self.hostname = hostname
         self.port = port
         self.server = server
 
 
+class TableReport:
+    """
+    Values of many instances of the same kind (CPUs, disks, NICs) in one report.
+
+    instances - Suffixes of the instances, the item key of a value is "<key>.<column>.[<instance>]"
+    columns - Item names with a list of values, one value per instance. None values are not sent.
+    """
+
+    def __init__(
+            self,
+            key: str,
+            instances: List[str],
+            columns: Dict[str, list],
+            timestamp: int = None,
+            hostname: str = "default",
+            port: str = "default",
+            server: str = "default",
+            ns: int = 0,
+    ):
+        self.key = key.replace(" ", "_")
+        self.instances = [f"[{instance}]".replace(" ", "_") for instance in instances]
+        self.columns = columns
+        self.timestamp = timestamp
+        self.ns = ns
+        self.hostname = hostname
+        self.port = port
+        self.server = server
+
+
 class DiscoveryReport:
     def __init__(
             self,
@@ -40,25 +84,40 @@ class DiscoveryReport:
         self.key = key.replace(" ", "_")
         self.macros = macros
         self.values = values
-        self.timestamp = int(time.time())
+        self.timestamp = None
+        self.ns = 0
         self.hostname = hostname
         self.port = port
         self.server = server
 
 
 class Module(ABC):
+    """
+    isolated - Run the module in a separate worker process, so a slow collector doesn't share the GIL with the sender.
+               Can be overridden with the "isolated" option of the module section in the config file.
+    """
+    isolated = False
+    memory_limit = 0
+    cpu_time_limit = 0
+
     def __init__(
             self,
             data_interval: int = 60,
             discovery_interval: int = 300,
     ):
         self.name = self.__class__.__name__.lower()
+        self.hostname = "default"
+        # arguments the module was created with, a worker process creates the module again from them
+        self.init_kwargs = {}
         self.agent = None
         self.running = False
-        self.data_interval = int(data_interval)
-        self.discovery_interval = int(discovery_interval)
-        self.data_thread = Thread(target=self._update_data, args=[])
-        self.discovery_thread = Thread(target=self._update_discovery, args=[])
+        self.stop_event = Event()
+        self.data_interval = float(data_interval)
+        self.discovery_interval = float(discovery_interval)
+        # clock of the current collection, separate for the data and the discovery threads
+        self.tick = local()
+        self.data_thread = Thread(target=self._update_data, args=[], daemon=True)
+        self.discovery_thread = Thread(target=self._update_discovery, args=[], daemon=True)
         self._import_dependencies()
         self.config = {}
         logger.info(f"'{self.name}' module initialized successfully!")
@@ -74,11 +133,20 @@ class Module(ABC):
     def _import_dependencies(self) -> None:
         pass
 
-    @staticmethod
-    def timestamp() -> int:
-        return int(time.time())
+    def clock(self) -> Tuple[int, int]:
+        """
+        Clock of the current collection, (seconds, nanoseconds)
+        """
+        return getattr(self.tick, "clock", None) or clock()
+
+    def timestamp(self) -> int:
+        return self.clock()[0]
 
-    def _report(self, report: Union[DataReport, DiscoveryReport]):
+    def _report(self, report: Union[DataReport, TableReport, DiscoveryReport]):
+        if report.hostname == "default":
+            report.hostname = self.hostname
+        if report.timestamp is None:
+            report.timestamp, report.ns = self.clock()
         self.agent.report_queue.append(report)
 
     def report_exception(self, message: str):
@@ -88,21 +156,20 @@ class Module(ABC):
                 "exception": f"{self.name}: {message}"
             },
             key="pyzender",
-            timestamp=self.timestamp(),
         )
         self._report(exception)
 
     def _update_data(self):
-        while True:
-            time.sleep(self.data_interval)
+        while not self.stop_event.wait(self.data_interval):
+            self.tick.clock = clock()
             try:
                 self._collect_data_reports()
             except Exception as msg:
                 self.report_exception(str(msg))
 
     def _update_discovery(self):
-        while True:
-            time.sleep(self.discovery_interval)
+        while not self.stop_event.wait(self.discovery_interval):
+            self.tick.clock = clock()
             try:
                 self._collect_discovery_reports()
             except Exception as msg:
@@ -114,3 +181,11 @@ class Module(ABC):
         self.data_thread.start()
         self.running = True
         logger.info(f"'{self.name}' module started successfully!")
+
+    def stop(self):
+        """
+        Stop collecting. Threads finish after the current collection, a stopped module can't be started again.
+        """
+        self.stop_event.set()
+        self.running = False
+        logger.info(f"'{self.name}' module stopped")
@@ -0,0 +1,229 @@
+import errno
+import fnmatch
+import os
+from threading import Lock
+
+from pyzender.modules.base import Module, DiscoveryReport, TableReport
+
+CPU_STAT_KEYS = ("usage_usec", "user_usec", "system_usec", "nr_periods", "nr_throttled", "throttled_usec")
+MEMORY_STAT_KEYS = (
+    "anon", "file", "kernel", "kernel_stack", "slab", "sock", "shmem", "file_dirty", "file_writeback",
+    "pgfault", "pgmajfault",
+)
+IO_STAT_KEYS = ("rbytes", "wbytes", "rios", "wios")
+PRESSURE_RESOURCES = ("cpu", "memory", "io")
+PRESSURE_KEYS = ("some.avg10", "some.avg60", "some.total", "full.avg10", "full.avg60", "full.total")
+
+
+def parse_flat_keyed(data: bytes) -> dict:
+    """
+    "key value" lines, e.g. cpu.stat and memory.stat
+    """
+    values = {}
+    for line in data.split(b"\n"):
+        key, _, value = line.partition(b" ")
+        if value:
+            values[key.decode()] = int(value)
+    return values
+
+
+def parse_nested_keyed(data: bytes) -> dict:
+    """
+    "name key=value key=value" lines, e.g. io.stat and *.pressure. Values of the same name are summed.
+    """
+    values = {}
+    for line in data.split(b"\n"):
+        name, *pairs = line.split(b" ")
+        name = name.decode()
+        for pair in pairs:
+            key, _, value = pair.partition(b"=")
+            if value:
+                key = (name, key.decode())
+                values[key] = values.get(key, 0) + (float(value) if b"." in value else int(value))
+    return values
+
+
+class CGroups(Module):
+    """
+    Reads cgroup v2 files directly, without psutil.
+
+    root - Mount point of the cgroup v2 hierarchy
+    max_depth - How deep the hierarchy is discovered, e.g. 2 for "system.slice/docker-<id>.scope"
+    include - Comma separated shell-style patterns of cgroup paths to monitor (all by default)
+    exclude - Comma separated shell-style patterns of cgroup paths to skip
+    max_open_files - How many files are kept open between collections, the rest are reopened on every collection.
+                     Every cgroup has up to 7 files, keep it well below the open files limit of the agent.
+    """
+
+    def __init__(
+            self,
+            root: str = "/sys/fs/cgroup",
+            max_depth: int = 2,
+            include: str = "",
+            exclude: str = "",
+            max_open_files: int = 512,
+            data_interval: int = 60,
+            discovery_interval: int = 300,
+    ):
+        super(CGroups, self).__init__(data_interval, discovery_interval)
+        self.root = root
+        self.max_depth = int(max_depth)
+        self.include = [p.strip() for p in str(include).split(",") if p.strip()]
+        self.exclude = [p.strip() for p in str(exclude).split(",") if p.strip()]
+
+        self.max_open_files = int(max_open_files)
+
+        # Opened files are used only by the data thread, the discovery thread only replaces the list of cgroups.
+        # None means the file doesn't exist, e.g. the controller is not enabled for the cgroup.
+        self.descriptors = {}
+        self.open_files = 0
+        self.lock = Lock()
+        self.cgroups = self._find_cgroups()
+        self.known_cgroups = None
+
+    def _is_wanted(self, cgroup: str) -> bool:
+        if self.include and not any(fnmatch.fnmatchcase(cgroup, p) for p in self.include):
+            return False
+        return not any(fnmatch.fnmatchcase(cgroup, p) for p in self.exclude)
+
+    def _find_cgroups(self) -> list:
+        cgroups = []
+        root_depth = self.root.rstrip("/").count("/")
+
+        for path, directories, files in os.walk(self.root):
+            depth = path.rstrip("/").count("/") - root_depth
+            if depth >= self.max_depth:
+                directories.clear()
+
+            if "cgroup.controllers" in files:
+                cgroup = os.path.relpath(path, self.root)
+                if depth > 0 and self._is_wanted(cgroup):
+                    cgroups.append(cgroup)
+
+        return cgroups
+
+    def _collect_discovery_reports(self):
+        self.cgroups = self._find_cgroups()
+
+        discovery = DiscoveryReport(
+            key="cgroup.discovery", macros="{#CGROUP}",
+            values=self.cgroups
+        )
+        self._report(discovery)
+
+    def _read(self, cgroup: str, file_name: str):
+        """
+        Read a file through a descriptor that stays open between collections, while there are less than
+        max_open_files of them. Returns None if it is not available.
+        """
+        key = (cgroup, file_name)
+        fd = self.descriptors.get(key)
+        if fd is None:
+            if key in self.descriptors:
+                # the controller is not enabled for this cgroup
+                return None
+            try:
+                fd = os.open(os.path.join(self.root, cgroup, file_name), os.O_RDONLY | os.O_CLOEXEC)
+            except OSError as reason:
+                if reason.errno == errno.ENOENT:
+                    self.descriptors[key] = None
+                return None
+
+            if self.open_files >= self.max_open_files:
+                try:
+                    return os.pread(fd, 65536, 0)
+                except OSError:
+                    return None
+                finally:
+                    os.close(fd)
+
+            self.descriptors[key] = fd
+            self.open_files += 1
+
+        try:
+            return os.pread(fd, 65536, 0)
+        except OSError:
+            # the cgroup was removed
+            self._close(key)
+            return None
+
+    def _close(self, key: tuple) -> None:
+        fd = self.descriptors.pop(key)
+        if fd is not None:
+            os.close(fd)
+            self.open_files -= 1
+
+    def _close_removed(self, cgroups: list) -> None:
+        """
+        Close files of removed cgroups after discovery. Missing files are checked again, controllers may be enabled.
+        """
+        if cgroups is self.known_cgroups:
+            return
+        self.known_cgroups = cgroups
+
+        wanted = set(cgroups)
+        for key, fd in list(self.descriptors.items()):
+            if fd is None or key[0] not in wanted:
+                self._close(key)
+
+    def stop(self):
+        super(CGroups, self).stop()
+        with self.lock:
+            for key in list(self.descriptors):
+                self._close(key)
+
+    def _collect_data_reports(self):
+        with self.lock:
+            if self.stop_event.is_set():
+                return
+            cgroups = self.cgroups
+            self._close_removed(cgroups)
+            columns = self._read_columns(cgroups)
+
+        data = TableReport(
+            key="cgroup",
+            instances=cgroups,
+            columns=columns,
+        )
+        self._report(data)
+
+    def _read_columns(self, cgroups: list) -> dict:
+
+        columns = {f"cpu.{key}": [] for key in CPU_STAT_KEYS}
+        columns["memory.current"] = []
+        columns.update({f"memory.{key}": [] for key in MEMORY_STAT_KEYS})
+        columns.update({f"io.{key}": [] for key in IO_STAT_KEYS})
+        columns.update({
+            f"pressure.{resource}.{key}": [] for resource in PRESSURE_RESOURCES for key in PRESSURE_KEYS
+        })
+
+        for cgroup in cgroups:
+            data = self._read(cgroup, "cpu.stat")
+            cpu_stat = parse_flat_keyed(data) if data else {}
+            for key in CPU_STAT_KEYS:
+                columns[f"cpu.{key}"].append(cpu_stat.get(key))
+
+            data = self._read(cgroup, "memory.current")
+            columns["memory.current"].append(int(data) if data else None)
+
+            data = self._read(cgroup, "memory.stat")
+            memory_stat = parse_flat_keyed(data) if data else {}
+            for key in MEMORY_STAT_KEYS:
+                columns[f"memory.{key}"].append(memory_stat.get(key))
+
+            data = self._read(cgroup, "io.stat")
+            io_stat = {}
+            if data is not None:
+                for (_, key), value in parse_nested_keyed(data).items():
+                    io_stat[key] = io_stat.get(key, 0) + value
+            for key in IO_STAT_KEYS:
+                columns[f"io.{key}"].append(io_stat.get(key, 0 if data is not None else None))
+
+            for resource in PRESSURE_RESOURCES:
+                data = self._read(cgroup, f"{resource}.pressure")
+                pressure = parse_nested_keyed(data) if data else {}
+                for key in PRESSURE_KEYS:
+                    value = pressure.get(tuple(key.split(".")))
+                    columns[f"pressure.{resource}.{key}"].append(value)
+
+        return columns
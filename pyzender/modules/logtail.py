@@ -0,0 +1,344 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import re
+import struct
+import time
+from threading import Lock
+
+from pyzender.modules.base import Module, DataReport, DiscoveryReport
+
+logger = logging.getLogger()
+
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+DIRECTORY_MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 1048576
+CHECKPOINT_DIR = "/var/lib/pyzender"
+
+
+class Inotify:
+    """
+    Minimal inotify wrapper on top of libc. Raises OSError when inotify is not available.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() has failed")
+        self.watches = {}
+
+    def add_watch(self, directory: str, mask: int = DIRECTORY_MASK) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch() has failed for {directory}")
+        self.watches[wd] = directory
+
+    def close(self) -> None:
+        os.close(self.fd)
+        self.watches = {}
+
+    def changed_paths(self):
+        """
+        Drain all pending events. Returns a set of changed paths, or None if some events were lost.
+        """
+        paths = set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return paths
+
+            position = 0
+            while position < len(buffer):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, position)
+                position += EVENT_HEADER.size
+                name = buffer[position:position + length].rstrip(b"\0")
+                position += length
+
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if wd in self.watches:
+                    paths.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+
+
+class TailedFile:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        self.partial = b""
+        self.behind = False
+        # size of the file when it was checked last time
+        self.size = 0
+        self.skipped = 0
+
+    @property
+    def checkpoint(self) -> dict:
+        # an incomplete line at the end will be read again after restart
+        return {"inode": self.inode, "offset": self.offset - len(self.partial)}
+
+    def open(self, offset: int) -> None:
+        self.close()
+        self.file = open(self.path, "rb", buffering=0)
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.offset = offset
+        self.partial = b""
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def read(self, limit: int) -> bytes:
+        """
+        Read up to limit bytes of complete lines starting from the current offset
+        """
+        self.file.seek(self.offset)
+        chunks = [self.partial]
+        size = 0
+        while size < limit:
+            chunk = self.file.read(READ_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+
+        self.offset += size
+        self.behind = size >= limit
+        data = b"".join(chunks)
+        end = data.rfind(b"\n") + 1
+        if end == 0 and len(data) < READ_SIZE:
+            self.partial = data
+            return b""
+
+        self.partial = data[end:] if end else b""
+        return data[:end] if end else data
+
+
+class LogTail(Module):
+    """
+    files - Comma separated paths of the log files to follow
+    checkpoint_path - File where the read offsets are stored between restarts. By default it is
+                      /var/lib/pyzender/logtail.json, or logtail@<host>.json for a "[logtail@<host>]" section.
+    max_lines - Maximum number of matched lines reported for one rule and one file per collection
+    max_read - Number of bytes read and matched at once. Files are read in such chunks until the end.
+    max_read_time - Seconds one file may be read for per collection, the rest is read next time
+    from_beginning - Read files that have no checkpoint from the beginning instead of the end
+
+    Rules are the remaining options of the section:
+        count_<name> = <regex> - number of lines matching the regex, reported as logtail.count.<name>.[<file>]
+        match_<name> = <regex> - matching lines themselves, reported as logtail.match.<name>.[<file>]
+    Use "%%" for "%" in regexes, since the config file supports interpolation.
+
+    Every file also reports logtail.bytes.[<file>] and logtail.skipped_bytes.[<file>] - bytes that were lost
+    because the file was truncated before they were read.
+    """
+
+    def __init__(
+            self,
+            files: str,
+            checkpoint_path: str = "",
+            max_lines: int = 100,
+            max_read: int = 4194304,
+            max_read_time: int = 10,
+            from_beginning: bool = False,
+            data_interval: int = 60,
+            discovery_interval: int = 300,
+            **rules,
+    ):
+        super(LogTail, self).__init__(data_interval, discovery_interval)
+        self.checkpoint_path = checkpoint_path
+        self.max_lines = int(max_lines)
+        self.max_read = int(max_read)
+        self.max_read_time = float(max_read_time)
+        self.from_beginning = bool(int(from_beginning))
+        self.count_rules = {}
+        self.match_rules = {}
+        self.lock = Lock()
+
+        for option, pattern in rules.items():
+            kind, _, rule = option.partition("_")
+            # each regex is applied to the whole chunk, "^.*?" makes it match at most once per line
+            if kind == "count" and rule:
+                self.count_rules[rule] = re.compile(rb"^.*?(?:" + str(pattern).encode() + rb")", re.MULTILINE)
+            elif kind == "match" and rule:
+                self.match_rules[rule] = re.compile(rb"^.*?(?:" + str(pattern).encode() + rb").*$", re.MULTILINE)
+            else:
+                raise ValueError(f"Unknown option '{option}', rules must start with 'count_' or 'match_'")
+
+        self.files = [TailedFile(os.path.abspath(p.strip())) for p in str(files).split(",") if p.strip()]
+        # loaded on the first collection, when the host of the module is known
+        self.checkpoints = None
+
+        try:
+            self.inotify = Inotify()
+            for directory in {os.path.dirname(f.path) for f in self.files}:
+                self.inotify.add_watch(directory)
+        except (OSError, AttributeError) as reason:
+            logger.warning(f"inotify is not available, '{self.name}' module will poll files. {str(reason)}")
+            self.inotify = None
+
+    def _load_checkpoints(self) -> dict:
+        if not self.checkpoint_path:
+            file_name = "logtail.json" if self.hostname == "default" else f"logtail@{self.hostname}.json"
+            self.checkpoint_path = os.path.join(CHECKPOINT_DIR, file_name)
+
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as reason:
+            logger.error(f"Failed to read checkpoints from {self.checkpoint_path}. {str(reason)}")
+            return {}
+
+    def _save_checkpoints(self) -> None:
+        temporary_path = f"{self.checkpoint_path}.tmp"
+        try:
+            with open(temporary_path, "w") as checkpoint_file:
+                json.dump(self.checkpoints, checkpoint_file)
+            os.replace(temporary_path, self.checkpoint_path)
+        except OSError as reason:
+            logger.error(f"Failed to save checkpoints to {self.checkpoint_path}. {str(reason)}")
+
+    def stop(self):
+        super(LogTail, self).stop()
+        with self.lock:
+            for tailed in self.files:
+                tailed.close()
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+
+    def _collect_data_reports(self):
+        with self.lock:
+            if not self.stop_event.is_set():
+                self._tail_files()
+
+    def _tail_files(self):
+        # None means that changes are unknown and every file has to be checked
+        changed = self.inotify.changed_paths() if self.inotify else None
+        checkpoints_changed = False
+        if self.checkpoints is None:
+            self.checkpoints = self._load_checkpoints()
+
+        for tailed in self.files:
+            if changed is not None and tailed.file and not tailed.behind and tailed.path not in changed:
+                continue
+
+            self._apply_rules(tailed, self._follow(tailed, time.monotonic() + self.max_read_time))
+
+            if self.checkpoints.get(tailed.path) != tailed.checkpoint:
+                self.checkpoints[tailed.path] = tailed.checkpoint
+                checkpoints_changed = True
+
+        if checkpoints_changed:
+            self._save_checkpoints()
+
+    def _collect_discovery_reports(self):
+        discovery = DiscoveryReport(
+            key="logtail.file.discovery", macros="{#LOGFILE}",
+            values=[f.path for f in self.files]
+        )
+        self._report(discovery)
+
+    def _follow(self, tailed: TailedFile, deadline: float):
+        """
+        Handle rotation and truncation, then yield new lines of the file chunk by chunk,
+        until the end of the file or the deadline (time.monotonic())
+        """
+        try:
+            stat = os.stat(tailed.path)
+        except FileNotFoundError:
+            # rotated away and not recreated yet, finish reading the old file
+            stat = None
+
+        if tailed.file is None:
+            if stat is None:
+                return
+            checkpoint = self.checkpoints.get(tailed.path, {})
+            if checkpoint.get("inode") == stat.st_ino and checkpoint.get("offset", 0) <= stat.st_size:
+                tailed.open(checkpoint["offset"])
+            else:
+                tailed.open(0 if self.from_beginning else stat.st_size)
+
+        elif stat is not None and stat.st_ino == tailed.inode and stat.st_size < tailed.offset:
+            skipped = max(tailed.size - tailed.offset, 0)
+            logger.warning(f"{tailed.path} was truncated, at least {skipped} unread bytes were skipped")
+            tailed.skipped += skipped
+            tailed.open(0)
+
+        while True:
+            data = tailed.read(self.max_read)
+            if data:
+                yield data
+
+            if not tailed.behind:
+                if stat is None or stat.st_ino == tailed.inode:
+                    tailed.size = stat.st_size if stat else tailed.offset
+                    return
+
+                # the old file is read till the end, only now switch to the new one
+                logger.info(f"{tailed.path} was rotated")
+                partial = tailed.partial
+                tailed.open(0)
+                if partial:
+                    yield partial
+
+            elif time.monotonic() >= deadline:
+                logger.warning(f"{tailed.path} is not read till the end in {self.max_read_time} s, continuing later")
+                return
+
+    def _apply_rules(self, tailed: TailedFile, chunks):
+        """
+        Apply the rules to every chunk as soon as it is read, so only one chunk is kept in memory
+        """
+        size = 0
+        counts = dict.fromkeys(self.count_rules, 0)
+        matches = {rule: [] for rule in self.match_rules}
+
+        for data in chunks:
+            size += len(data)
+            for rule, regex in self.count_rules.items():
+                counts[rule] += len(regex.findall(data))
+
+            for rule, regex in self.match_rules.items():
+                lines = matches[rule]
+                for line in regex.finditer(data):
+                    if len(lines) >= self.max_lines:
+                        break
+                    lines.append(line.group().decode("utf-8", errors="replace").rstrip("\r"))
+
+        data_report = DataReport(
+            items={
+                "bytes": size,
+                "skipped_bytes": tailed.skipped,
+                "count": counts,
+            },
+            key="logtail",
+            append_key=f"[{tailed.path}]",
+        )
+        self._report(data_report)
+        tailed.skipped = 0
+
+        for rule, lines in matches.items():
+            for line in lines:
+                match_report = DataReport(
+                    items={rule: line},
+                    key="logtail.match",
+                    append_key=f"[{tailed.path}]",
+                )
+                self._report(match_report)
@@ -0,0 +1,204 @@
+import heapq
+import logging
+import time
+from bisect import bisect_left
+from operator import itemgetter
+
+from pyzender.modules.base import Module, DataReport, DiscoveryReport
+
+PROCESS_ATTRS = ["pid", "name", "create_time", "cpu_times", "memory_info", "io_counters"]
+
+# Positions in a process row
+CPU, RSS, IO, PID, NAME = range(5)
+RANKINGS = {"cpu": CPU, "rss": RSS, "io": IO}
+
+logger = logging.getLogger()
+
+
+class Processes(Module):
+    """
+    top_n - How many processes are reported for each ranking (CPU, RSS, IO)
+    cpu_budget - CPU time in milliseconds that one collection may take. Processes that didn't fit into
+                 the budget are reported with their values from the previous scan, the next collection starts
+                 from them.
+    groups - Comma separated process names to roll up. When empty, the top_n names by RSS are discovered.
+    """
+
+    def __init__(
+            self,
+            top_n: int = 10,
+            cpu_budget: int = 200,
+            groups: str = "",
+            data_interval: int = 60,
+            discovery_interval: int = 300,
+    ):
+        super(Processes, self).__init__(data_interval, discovery_interval)
+        self.top_n = int(top_n)
+        self.cpu_budget = int(cpu_budget) / 1000
+        self.groups = [self._fix_name(g.strip()) for g in str(groups).split(",") if g.strip()]
+
+        # pid -> (create_time, cpu seconds, io bytes, monotonic time) from the previous collection
+        self.baselines = {}
+        self.group_rss = {}
+        # pid -> psutil.Process, kept between collections like process_iter() does
+        self.processes = {}
+        # pid -> the last row of the process, used for processes skipped because of the CPU budget
+        self.rows = {}
+        # the first pid that wasn't scanned because of the CPU budget
+        self.resume_pid = 0
+
+    def _import_dependencies(self):
+        import psutil
+
+        self.psutil = psutil
+
+    @staticmethod
+    def _fix_name(process_name: str) -> str:
+        return process_name.replace(" ", "_").replace("[", "(").replace("]", ")").replace(",", ".")
+
+    def _collect_data_reports(self):
+        rows, budget_exceeded = self._scan_processes()
+
+        summary = DataReport(
+            items={"count": len(rows), "budget_exceeded": int(budget_exceeded)},
+            key="psutil.process",
+        )
+        self._report(summary)
+
+        self._top_processes(rows)
+        self._process_groups(rows)
+
+    def _collect_discovery_reports(self):
+        groups = self.groups or heapq.nlargest(self.top_n, self.group_rss, key=self.group_rss.get)
+        if not groups:
+            return
+
+        discovery = DiscoveryReport(
+            key="psutil.process.group.discovery", macros="{#PROCESS_GROUP}",
+            values=groups
+        )
+        self._report(discovery)
+
+        discovery = DiscoveryReport(
+            key="psutil.process.top.discovery", macros="{#RANK}",
+            values=[str(rank) for rank in range(1, self.top_n + 1)]
+        )
+        self._report(discovery)
+
+    def _scan_processes(self) -> tuple:
+        """
+        Walk all processes once. CPU and IO are calculated as rates against the previous collection.
+        Returns rows of all running processes, and whether some of them were not scanned this time.
+        """
+        now = time.monotonic()
+        # CPU time of this thread only, other modules and the sender don't eat the budget
+        started = time.thread_time()
+        budget_exceeded = False
+        baselines = {}
+        processes = {}
+        rows = {}
+
+        pids = self.psutil.pids()
+        start = bisect_left(pids, self.resume_pid)
+        self.resume_pid = 0
+
+        for index, pid in enumerate(pids[start:] + pids[:start]):
+            if index & 63 == 0 and time.thread_time() - started > self.cpu_budget:
+                budget_exceeded = True
+                self.resume_pid = pid
+                break
+
+            process = self.processes.get(pid)
+            try:
+                if process is None or not process.is_running():
+                    process = self.psutil.Process(pid)
+                # as_dict() reads all attrs inside oneshot()
+                info = process.as_dict(attrs=PROCESS_ATTRS, ad_value=None)
+            except self.psutil.NoSuchProcess:
+                continue
+            processes[pid] = process
+
+            cpu_times = info["cpu_times"]
+            io_counters = info["io_counters"]
+            memory_info = info["memory_info"]
+
+            cpu_seconds = cpu_times.user + cpu_times.system if cpu_times else 0.0
+            io_bytes = io_counters.read_bytes + io_counters.write_bytes if io_counters else 0
+            rss = memory_info.rss if memory_info else 0
+
+            baseline = self.baselines.get(pid)
+            if baseline and baseline[0] == info["create_time"] and now > baseline[3]:
+                elapsed = now - baseline[3]
+                cpu = round((cpu_seconds - baseline[1]) / elapsed * 100, 2)
+                io = round((io_bytes - baseline[2]) / elapsed)
+            else:
+                cpu = 0.0
+                io = 0
+
+            baselines[pid] = (info["create_time"], cpu_seconds, io_bytes, now)
+            rows[pid] = (cpu, rss, io, pid, self._fix_name(info["name"] or ""))
+
+        if budget_exceeded:
+            logger.warning(
+                f"'{self.name}' module has exceeded its CPU budget of {self.cpu_budget * 1000:.0f} ms"
+                f" after {len(rows)} processes"
+            )
+            # keep the processes that were skipped this time, unless they are gone
+            running = set(pids)
+            for previous, current in ((self.baselines, baselines), (self.processes, processes), (self.rows, rows)):
+                for pid, value in previous.items():
+                    if pid in running and pid not in current:
+                        current[pid] = value
+
+        self.baselines = baselines
+        self.processes = processes
+        self.rows = rows
+
+        return list(rows.values()), budget_exceeded
+
+    def _top_processes(self, rows: list):
+        for ranking, position in RANKINGS.items():
+            top = heapq.nlargest(self.top_n, rows, key=itemgetter(position))
+
+            for rank, row in enumerate(top, start=1):
+                data = DataReport(
+                    items={
+                        "pid": row[PID],
+                        "name": row[NAME],
+                        "cpu": row[CPU],
+                        "rss": row[RSS],
+                        "io": row[IO],
+                    },
+                    key=f"psutil.process.top_{ranking}",
+                    append_key=f"[{rank}]",
+                )
+                self._report(data)
+
+    def _process_groups(self, rows: list):
+        totals = {}
+        for row in rows:
+            group = totals.get(row[NAME])
+            if group is None:
+                totals[row[NAME]] = [1, row[CPU], row[RSS], row[IO]]
+            else:
+                group[0] += 1
+                group[1] += row[CPU]
+                group[2] += row[RSS]
+                group[3] += row[IO]
+
+        self.group_rss = {name: group[2] for name, group in totals.items()}
+        groups = self.groups or heapq.nlargest(self.top_n, self.group_rss, key=self.group_rss.get)
+
+        for name in groups:
+            count, cpu, rss, io = totals.get(name, (0, 0.0, 0, 0))
+            data = DataReport(
+                items={
+                    "count": count,
+                    "cpu": round(cpu, 2),
+                    "rss": rss,
+                    "io": io,
+                },
+                key="psutil.process.group",
+                append_key=f"[{name}]",
+            )
+            self._report(data)
@@ -1,10 +1,38 @@
-from pyzender.modules.base import Module, DataReport, DiscoveryReport
+import time
+from threading import Thread
+
+from pyzender.modules.base import Module, DataReport, DiscoveryReport, TableReport
+from pyzender.modules.sampling import RingBuffer, SECTOR_SIZE, read_cpu_times, read_disk_sectors
 
 IP4_ADDRESS_FAMILY = 2
 IP6_ADDRESS_FAMILY = 10
 
 
 class PSUtil(Module):
+    """
+    sampling_interval - Sample CPU usage and disk throughput from /proc every N milliseconds (0 - disabled).
+                        Only min/max/avg/p95 of the samples are sent once per data_interval.
+    sampling_metrics - Comma separated metrics to sample: cpu, disk
+    sampling_size - Maximum number of samples kept between two data collections
+    """
+
+    def __init__(
+            self,
+            sampling_interval: int = 0,
+            sampling_metrics: str = "cpu,disk",
+            sampling_size: int = 4096,
+            data_interval: int = 60,
+            discovery_interval: int = 300,
+    ):
+        super(PSUtil, self).__init__(data_interval, discovery_interval)
+        self.sampling_interval = int(sampling_interval) / 1000
+        self.sampling_metrics = {m.strip() for m in str(sampling_metrics).split(",") if m.strip()}
+        self.sampling_size = int(sampling_size)
+        if self.sampling_size < 1:
+            raise ValueError(f"sampling_size must be at least 1, got {sampling_size}")
+        self.samples = {}
+        self.sampling_thread = Thread(target=self._sample, args=[], daemon=True)
+
     def _import_dependencies(self):
         import psutil
 
@@ -20,6 +48,11 @@ class PSUtil(Module):
         excluded_fstypes = ["squashfs"]
         return [p for p in disk_partitions if p.fstype not in excluded_fstypes]
 
+    def run(self, agent):
+        super(PSUtil, self).run(agent)
+        if self.sampling_interval:
+            self.sampling_thread.start()
+
     def _collect_data_reports(self):
         self._cpu()
         self._memory()
@@ -27,6 +60,77 @@ class PSUtil(Module):
         self._mountpoints()
         self._temperature_sensors()
         self._networks()
+        self._sampled()
+
+    def _buffer(self, name: str) -> RingBuffer:
+        buffer = self.samples.get(name)
+        if buffer is None:
+            buffer = self.samples[name] = RingBuffer(self.sampling_size)
+        return buffer
+
+    def _sample(self):
+        """
+        Read /proc directly on every sample, psutil is too slow for sub-second intervals
+        """
+        previous_cpu = previous_disks = None
+        previous_time = time.monotonic()
+
+        while not self.stop_event.wait(self.sampling_interval):
+            try:
+                now = time.monotonic()
+                elapsed = now - previous_time
+                previous_time = now
+
+                if "cpu" in self.sampling_metrics:
+                    cpu = read_cpu_times()
+                    if previous_cpu and cpu[2] > previous_cpu[2]:
+                        total = cpu[2] - previous_cpu[2]
+                        self._buffer("usage").append((cpu[0] - previous_cpu[0]) / total * 100)
+                        self._buffer("iowait").append((cpu[1] - previous_cpu[1]) / total * 100)
+                    previous_cpu = cpu
+
+                if "disk" in self.sampling_metrics:
+                    disks = read_disk_sectors()
+                    if previous_disks and elapsed > 0:
+                        for disk, (read, written) in disks.items():
+                            if disk in previous_disks and self._is_disk_useful(disk):
+                                read_before, written_before = previous_disks[disk]
+                                self._buffer(f"read_bytes_rate[{disk}]").append(
+                                    (read - read_before) * SECTOR_SIZE / elapsed
+                                )
+                                self._buffer(f"write_bytes_rate[{disk}]").append(
+                                    (written - written_before) * SECTOR_SIZE / elapsed
+                                )
+                    previous_disks = disks
+
+            except (OSError, ValueError, IndexError) as msg:
+                self.report_exception(f"Sampling has failed: {str(msg)}")
+                self.stop_event.wait(self.data_interval)
+
+    def _sampled(self):
+        if not self.samples:
+            return
+
+        cpu_items = {}
+        for metric in ("usage", "iowait"):
+            summary = self.samples[metric].summary() if metric in self.samples else {}
+            if summary:
+                cpu_items[metric] = summary
+
+        if cpu_items:
+            data = DataReport(items=cpu_items, key="psutil.cpu.sampled")
+            self._report(data)
+
+        disks = sorted({name[name.index("[") + 1:-1] for name in list(self.samples) if "[" in name})
+        if disks:
+            columns = {}
+            for metric in ("read_bytes_rate", "write_bytes_rate"):
+                summaries = [self.samples[f"{metric}[{disk}]"].summary() for disk in disks]
+                for statistic in ("min", "max", "avg", "p95"):
+                    columns[f"{metric}.{statistic}"] = [summary.get(statistic) for summary in summaries]
+
+            data = TableReport(key="psutil.disk.sampled", instances=disks, columns=columns)
+            self._report(data)
 
     def _collect_discovery_reports(self):
         self._discover_threads()
@@ -96,39 +200,42 @@ class PSUtil(Module):
 
     def _per_nic_stats(self):
         nic_stats = self.psutil.net_if_stats()
-        timestamp = self.timestamp()
-
-        for nic, stats in nic_stats.items():
-            nic_items = {
-                "isup": int(stats.isup),
-                "duplex": stats.duplex,
-                "speed": stats.speed,
-                "mtu": stats.mtu,
-            }
-            data = DataReport(items=nic_items, key="psutil.net", append_key=f"[{nic}]", timestamp=timestamp)
-            self._report(data)
+        stats = nic_stats.values()
+
+        data = TableReport(
+            key="psutil.net",
+            instances=list(nic_stats),
+            columns={
+                "isup": [int(s.isup) for s in stats],
+                "duplex": [s.duplex for s in stats],
+                "speed": [s.speed for s in stats],
+                "mtu": [s.mtu for s in stats],
+            },
+        )
+        self._report(data)
 
     def _per_nic_io_counters(self):
         nic_counters = self.psutil.net_io_counters(pernic=True)
-        timestamp = self.timestamp()
-
-        for nic, counters in nic_counters.items():
-            nic_items = {
-                "bytes_recv": counters.bytes_recv,
-                "bytes_sent": counters.bytes_sent,
-                "packets_recv": counters.packets_recv,
-                "packets_sent": counters.packets_sent,
-                "dropin": counters.dropin,
-                "dropout": counters.dropout,
-                "errin": counters.errin,
-                "errout": counters.errout,
-            }
-            data = DataReport(items=nic_items, key="psutil.net", append_key=f"[{nic}]", timestamp=timestamp)
-            self._report(data)
+        counters = nic_counters.values()
+
+        data = TableReport(
+            key="psutil.net",
+            instances=list(nic_counters),
+            columns={
+                "bytes_recv": [c.bytes_recv for c in counters],
+                "bytes_sent": [c.bytes_sent for c in counters],
+                "packets_recv": [c.packets_recv for c in counters],
+                "packets_sent": [c.packets_sent for c in counters],
+                "dropin": [c.dropin for c in counters],
+                "dropout": [c.dropout for c in counters],
+                "errin": [c.errin for c in counters],
+                "errout": [c.errout for c in counters],
+            },
+        )
+        self._report(data)
 
     def _per_nic_addresses(self):
         nic_addresses = self.psutil.net_if_addrs()
-        timestamp = self.timestamp()
 
         for nic, addresses in nic_addresses.items():
             nic_items = {}
@@ -155,55 +262,47 @@ class PSUtil(Module):
                     }
                     nic_items.update(ip6)
 
-                data = DataReport(items=nic_items, key="psutil.net", append_key=f"[{nic}]", timestamp=timestamp, )
+                data = DataReport(items=nic_items, key="psutil.net", append_key=f"[{nic}]")
                 self._report(data)
 
     def _per_cpu_usage(self):
         per_cpu_usage = self.psutil.cpu_percent(percpu=True)
-        timestamp = self.timestamp()
 
-        for index, usage in enumerate(per_cpu_usage):
-            data = DataReport(
-                items={"usage": usage},
-                key="psutil.cpu",
-                append_key=f"[{index}]",
-                timestamp=timestamp,
-            )
-            self._report(data)
+        data = TableReport(
+            key="psutil.cpu",
+            instances=[str(index) for index in range(len(per_cpu_usage))],
+            columns={"usage": per_cpu_usage},
+        )
+        self._report(data)
 
     def _per_cpu_frequency(self):
         per_cpu_frequency = self.psutil.cpu_freq(percpu=True)
-        timestamp = self.timestamp()
 
-        for index, frequency in enumerate(per_cpu_frequency):
-            data = DataReport(
-                items={"current": frequency.current},
-                key="psutil.cpu.frequency",
-                append_key=f"[{index}]",
-                timestamp=timestamp,
-            )
-            self._report(data)
+        data = TableReport(
+            key="psutil.cpu.frequency",
+            instances=[str(index) for index in range(len(per_cpu_frequency))],
+            columns={"current": [frequency.current for frequency in per_cpu_frequency]},
+        )
+        self._report(data)
 
     def _per_disk_counters(self):
         per_disk_counters = self.psutil.disk_io_counters(perdisk=True, nowrap=False)
-        timestamp = self.timestamp()
-
-        for disk, counters in per_disk_counters.items():
-            if self._is_disk_useful(disk):
-                data = DataReport(
-                    items={
-                        "read_count": counters.read_count,
-                        "write_count": counters.write_count,
-                        "read_bytes": counters.read_bytes,
-                        "write_bytes": counters.write_bytes,
-                        "read_time": counters.read_time,
-                        "write_time": counters.write_time,
-                    },
-                    key="psutil.disk",
-                    append_key=f"[{disk}]",
-                    timestamp=timestamp,
-                )
-                self._report(data)
+        disks = [disk for disk in per_disk_counters if self._is_disk_useful(disk)]
+        counters = [per_disk_counters[disk] for disk in disks]
+
+        data = TableReport(
+            key="psutil.disk",
+            instances=disks,
+            columns={
+                "read_count": [c.read_count for c in counters],
+                "write_count": [c.write_count for c in counters],
+                "read_bytes": [c.read_bytes for c in counters],
+                "write_bytes": [c.write_bytes for c in counters],
+                "read_time": [c.read_time for c in counters],
+                "write_time": [c.write_time for c in counters],
+            },
+        )
+        self._report(data)
 
     def _cpu_general(self):
         cores = self.psutil.cpu_count(logical=False)
@@ -243,7 +342,6 @@ class PSUtil(Module):
                 },
             },
             key="psutil.cpu",
-            timestamp=self.timestamp(),
         )
         self._report(data)
 
@@ -280,7 +378,6 @@ class PSUtil(Module):
                 },
             },
             key="psutil",
-            timestamp=self.timestamp(),
         )
         self._report(data)
 
@@ -297,7 +394,6 @@ class PSUtil(Module):
                 "write_time": disk_io.write_time,
             },
             key="psutil.disk",
-            timestamp=self.timestamp(),
         )
         self._report(data)
 
@@ -305,7 +401,6 @@ class PSUtil(Module):
 
     def _mountpoints(self):
         partitions = self._get_useful_partitions()
-        timestamp = self.timestamp()
 
         for p in partitions:
             usage = self.psutil.disk_usage(p.mountpoint)
@@ -323,25 +418,25 @@ class PSUtil(Module):
                 },
                 key="psutil.mountpoint",
                 append_key=f"[{p.mountpoint}]",
-                timestamp=timestamp,
             )
             self._report(data)
 
     def _temperature_sensors(self):
         temperature_sensors = self.psutil.sensors_temperatures(fahrenheit=False)
-        timestamp = self.timestamp()
 
+        sensors = []
+        currents = []
         for sensor, readings in temperature_sensors.items():
             for reading in readings:
-                data = DataReport(
-                    items={
-                        "current": reading.current,
-                    },
-                    key="psutil.sensors.temperature",
-                    append_key=f"[{sensor}.{reading.label}]",
-                    timestamp=timestamp,
-                )
-                self._report(data)
+                sensors.append(f"{sensor}.{reading.label}")
+                currents.append(reading.current)
+
+        data = TableReport(
+            key="psutil.sensors.temperature",
+            instances=sensors,
+            columns={"current": currents},
+        )
+        self._report(data)
 
     def _networks(self):
         net_io = self.psutil.net_io_counters()
@@ -358,7 +453,6 @@ class PSUtil(Module):
                 "errout": net_io.errout,
             },
             key="psutil.net",
-            timestamp=self.timestamp(),
         )
         self._report(data)
 
@@ -58,7 +58,6 @@ class QBittorrent(Module):
         self._report(discovery)
 
     def per_torrent_info(self):
-        timestamp = self.timestamp()
 
         for torrent in self.qbt_client.torrents.info():
             name = self._fix_name(torrent.info.name)
@@ -66,6 +65,5 @@ class QBittorrent(Module):
                 items=dict(torrent.info),
                 key="qbittorrent.torrent",
                 append_key=f"[{name}]",
-                timestamp=timestamp,
             )
             self._report(data)
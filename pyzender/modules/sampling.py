@@ -0,0 +1,76 @@
+import math
+from array import array
+from threading import Lock
+
+SECTOR_SIZE = 512
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of float samples. When it is full, the oldest samples are overwritten.
+    """
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(f"RingBuffer size must be at least 1, got {size}")
+        self.samples = array("d", bytes(8 * size))
+        self.size = size
+        self.position = 0
+        self.count = 0
+        self.lock = Lock()
+
+    def append(self, sample: float) -> None:
+        with self.lock:
+            self.samples[self.position] = sample
+            self.position = (self.position + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def summary(self) -> dict:
+        """
+        min/max/avg/p95 of the samples collected since the previous summary. Empty if there were no samples.
+        """
+        with self.lock:
+            if self.count == self.size:
+                samples = sorted(self.samples)
+            else:
+                start = (self.position - self.count) % self.size
+                if start + self.count <= self.size:
+                    samples = sorted(self.samples[start:start + self.count])
+                else:
+                    samples = sorted(self.samples[start:] + self.samples[:self.position])
+            self.count = 0
+
+        if not samples:
+            return {}
+
+        return {
+            "min": round(samples[0], 2),
+            "max": round(samples[-1], 2),
+            "avg": round(sum(samples) / len(samples), 2),
+            "p95": round(samples[math.ceil(0.95 * len(samples)) - 1], 2),
+        }
+
+
+def read_cpu_times() -> tuple:
+    """
+    (busy, iowait, total) jiffies of all CPUs from /proc/stat
+    """
+    with open("/proc/stat", "rb") as stat:
+        fields = [int(field) for field in stat.readline().split()[1:]]
+
+    # user nice system idle iowait irq softirq steal, guest time is already counted in user and nice
+    idle, iowait = fields[3], fields[4]
+    total = sum(fields[:8])
+    return total - idle - iowait, iowait, total
+
+
+def read_disk_sectors() -> dict:
+    """
+    {disk: (sectors read, sectors written)} from /proc/diskstats
+    """
+    sectors = {}
+    with open("/proc/diskstats", "rb") as diskstats:
+        for line in diskstats:
+            fields = line.split()
+            sectors[fields[2].decode()] = (int(fields[5]), int(fields[9]))
+    return sectors
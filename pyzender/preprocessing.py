@@ -0,0 +1,201 @@
+import json
+import logging
+import re
+
+from pyzender.retention import compile_patterns
+
+logger = logging.getLogger()
+
+# Returned by a step when the value must not be sent
+DISCARD = object()
+
+# Limit of the per-key state of one step, keys of e.g. finished torrents would stay there forever
+MAX_CACHED_KEYS = 100000
+
+JSONPATH_TOKEN = re.compile(r"\.([A-Za-z_][\w-]*)|\[(-?\d+)\]|\['([^']*)'\]|\[\"([^\"]*)\"\]")
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) else float(value)
+
+
+def _remember(previous: dict, key: str, value) -> None:
+    if len(previous) >= MAX_CACHED_KEYS and key not in previous:
+        previous.clear()
+    previous[key] = value
+
+
+def change_per_second():
+    previous = {}
+
+    def step(key, value, timestamp):
+        value = _number(value)
+        last = previous.get(key)
+        _remember(previous, key, (value, timestamp))
+        if last is None or timestamp <= last[1] or value < last[0]:
+            return DISCARD
+        return (value - last[0]) / (timestamp - last[1])
+
+    return step
+
+
+def simple_change():
+    previous = {}
+
+    def step(key, value, timestamp):
+        value = _number(value)
+        last = previous.get(key)
+        _remember(previous, key, value)
+        if last is None or value < last:
+            return DISCARD
+        return value - last
+
+    return step
+
+
+def multiplier(factor: str):
+    factor = float(factor)
+
+    def step(key, value, timestamp):
+        return _number(value) * factor
+
+    return step
+
+
+def discard_unchanged():
+    previous = {}
+
+    def step(key, value, timestamp):
+        if previous.get(key, DISCARD) == value:
+            return DISCARD
+        _remember(previous, key, value)
+        return value
+
+    return step
+
+
+def round_value(digits: str = "0"):
+    digits = int(digits)
+
+    def step(key, value, timestamp):
+        value = round(_number(value), digits)
+        return int(value) if digits == 0 else value
+
+    return step
+
+
+def jsonpath(path: str):
+    """
+    Subset of JSONPath: "$.name", "$['name with spaces']", "$.list[0]" and their combinations
+    """
+    if not path.startswith("$"):
+        raise ValueError(f"JSONPath must start with '$': {path}")
+
+    accessors = []
+    position = 1
+    while position < len(path):
+        token = JSONPATH_TOKEN.match(path, position)
+        if not token:
+            raise ValueError(f"Unsupported JSONPath: {path}")
+        name, index, quoted, double_quoted = token.groups()
+        accessors.append(int(index) if index is not None else next(t for t in (name, quoted, double_quoted) if t))
+        position = token.end()
+
+    def step(key, value, timestamp):
+        if isinstance(value, str):
+            value = json.loads(value)
+        try:
+            for accessor in accessors:
+                value = value[accessor]
+        except (KeyError, IndexError, TypeError):
+            return DISCARD
+        return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+    return step
+
+
+STEPS = {
+    "change_per_second": change_per_second,
+    "simple_change": simple_change,
+    "multiplier": multiplier,
+    "discard_unchanged": discard_unchanged,
+    "round": round_value,
+    "jsonpath": jsonpath,
+}
+
+
+class PreprocessingRule:
+    """
+    Configured in a "[preprocessing <name>]" section of the config file:
+
+    keys - Comma separated shell-style patterns of the keys the rule is applied to
+    steps - Steps separated by "|", e.g. "change_per_second | multiplier 8 | round 2".
+            Available steps: change_per_second, simple_change, multiplier <factor>, discard_unchanged,
+            round <digits>, jsonpath <path>
+    suffix - Send the result as a new item "<key><suffix>" (before the "[...]" part) and keep the original item.
+             Without a suffix the original value is replaced.
+    """
+
+    def __init__(self, name: str, keys: str, steps: str, suffix: str = ""):
+        self.name = name
+        self.keys = compile_patterns(keys)
+        if self.keys is None:
+            raise ValueError(f"Preprocessing rule '{name}' has no keys")
+        self.suffix = suffix
+        self.steps = []
+        for step in str(steps).split("|"):
+            step_name, _, argument = step.strip().partition(" ")
+            if step_name not in STEPS:
+                raise ValueError(f"Unknown preprocessing step '{step_name}' in rule '{name}'")
+            self.steps.append(STEPS[step_name](argument.strip()) if argument.strip() else STEPS[step_name]())
+
+    def output_key(self, key: str) -> str:
+        if not self.suffix:
+            return key
+        base, separator, parameters = key.partition(".[")
+        return f"{base}{self.suffix}{separator}{parameters}"
+
+    def apply(self, key: str, value, timestamp: int):
+        for step in self.steps:
+            value = step(key, value, timestamp)
+            if value is DISCARD:
+                break
+        return value
+
+
+class Preprocessor:
+    max_cached_keys = MAX_CACHED_KEYS
+
+    def __init__(self, rules: list = ()):
+        self.rules = list(rules)
+        self.rules_per_key = {}
+
+    def process(self, key: str, value, timestamp: int):
+        """
+        Returns None if no rule matches the key. Otherwise returns a list of (key, value) produced by the rules
+        and whether the original value must be sent too.
+        """
+        rules = self.rules_per_key.get(key)
+        if rules is None:
+            rules = [rule for rule in self.rules if rule.keys.match(key)]
+            if len(self.rules_per_key) >= self.max_cached_keys:
+                self.rules_per_key.clear()
+            self.rules_per_key[key] = rules
+
+        if not rules:
+            return None
+
+        results = []
+        keep_original = True
+        for rule in rules:
+            try:
+                result = rule.apply(key, value, timestamp)
+            except (ValueError, TypeError, ZeroDivisionError) as reason:
+                logger.debug(f"Preprocessing rule '{rule.name}' has failed for '{key}'. {str(reason)}")
+                result = DISCARD
+
+            keep_original = keep_original and bool(rule.suffix)
+            if result is not DISCARD:
+                results.append((rule.output_key(key), result))
+
+        return results, keep_original
@@ -0,0 +1,152 @@
+import fnmatch
+import re
+import sys
+from collections import deque
+from threading import Lock
+
+PRIORITIES = ("critical", "normal", "bulk")
+CRITICAL, NORMAL, BULK = range(len(PRIORITIES))
+
+# a slot of a deque holds a pointer to the line
+DEQUE_SLOT_SIZE = 8
+
+
+def line_size(line: str) -> int:
+    """
+    Memory taken by a queued line, including the str object itself, not only its characters
+    """
+    return sys.getsizeof(line) + DEQUE_SLOT_SIZE
+
+
+def compile_patterns(patterns: str):
+    """
+    Comma separated shell-style key patterns, e.g. "pyzender.*, psutil.memory.*", compiled into one regex
+    """
+    patterns = [p.strip() for p in str(patterns).split(",") if p.strip()]
+    if not patterns:
+        return None
+
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns))
+
+
+class RetentionPolicy:
+    """
+    Configured in the [retention] section of the config file:
+
+    critical - Key patterns that are sent first and evicted last
+    bulk - Key patterns that are sent last and evicted first
+    bulk_keep_every - When a queue is full, only every N-th value of each bulk key is kept
+
+    Other keys have the "normal" priority.
+    """
+    max_cached_keys = 100000
+
+    def __init__(self, critical: str = "pyzender.*", bulk: str = "", bulk_keep_every: int = 1):
+        self.critical = compile_patterns(critical)
+        self.bulk = compile_patterns(bulk)
+        self.bulk_keep_every = max(int(bulk_keep_every), 1)
+        self.priorities = {}
+        self.counters = {}
+
+    def classify(self, key: str) -> int:
+        priority = self.priorities.get(key)
+        if priority is None:
+            if self.critical and self.critical.match(key):
+                priority = CRITICAL
+            elif self.bulk and self.bulk.match(key):
+                priority = BULK
+            else:
+                priority = NORMAL
+
+            if len(self.priorities) >= self.max_cached_keys:
+                self.priorities.clear()
+            self.priorities[key] = priority
+
+        return priority
+
+    def keep(self, key: str, priority: int, queue_is_full: bool) -> bool:
+        """
+        Downsample bulk keys while the queue is full
+        """
+        if not queue_is_full or priority != BULK or self.bulk_keep_every == 1:
+            return True
+
+        seen = self.counters.get(key, 0)
+        if len(self.counters) >= self.max_cached_keys:
+            self.counters.clear()
+        self.counters[key] = seen + 1
+        return seen % self.bulk_keep_every == 0
+
+
+class GroupQueue:
+    """
+    Lines of one queue group, kept in a separate FIFO for every priority.
+    size is the memory taken by the lines (see line_size), it is updated on every change.
+    """
+
+    def __init__(self):
+        self.lines = tuple(deque() for _ in PRIORITIES)
+        self.size = 0
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return sum(len(lines) for lines in self.lines)
+
+    def append(self, line: str, priority: int = NORMAL) -> None:
+        with self.lock:
+            self.lines[priority].append(line)
+            self.size += line_size(line)
+
+    def take(self, size: int) -> list:
+        """
+        Remove up to size oldest lines, critical first. Returns (priority, line) pairs.
+        """
+        portion = []
+        with self.lock:
+            for priority, lines in enumerate(self.lines):
+                while lines and len(portion) < size:
+                    line = lines.popleft()
+                    self.size -= line_size(line)
+                    portion.append((priority, line))
+
+        return portion
+
+    def take_lowest(self, max_size: int) -> list:
+        """
+        Remove the oldest lines with the lowest priority, until their total size reaches max_size
+        """
+        portion = []
+        taken = 0
+        with self.lock:
+            for priority in reversed(range(len(self.lines))):
+                lines = self.lines[priority]
+                while lines and taken < max_size:
+                    line = lines.popleft()
+                    taken += line_size(line)
+                    portion.append((priority, line))
+            self.size -= taken
+
+        return portion
+
+    def put_back(self, portion: list) -> None:
+        """
+        Return lines to the head of the queue, e.g. a portion that wasn't sent
+        """
+        with self.lock:
+            for priority, line in reversed(portion):
+                self.lines[priority].appendleft(line)
+                self.size += line_size(line)
+
+    def evict(self, count: int = None, size: int = None) -> None:
+        """
+        Drop count oldest lines or lines with the total size of size, starting from the lowest priority
+        """
+        with self.lock:
+            for lines in reversed(self.lines):
+                while lines and (count is None or count > 0) and (size is None or size > 0):
+                    line = lines.popleft()
+                    self.size -= line_size(line)
+                    if count is not None:
+                        count -= 1
+                    if size is not None:
+                        size -= line_size(line)
@@ -0,0 +1,182 @@
+import logging
+import os
+from urllib.parse import quote, unquote
+
+from pyzender.retention import line_size
+
+logger = logging.getLogger()
+
+SPILL_SUFFIX = ".spill"
+# records the with_ns option the spilled lines were formatted for
+FORMAT_FILE = "with_ns"
+
+
+class SpilledGroup:
+    def __init__(self, path: str, offset: int = 0):
+        self.path = path
+        self.offset = offset
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    @property
+    def unread(self) -> int:
+        return self.size - self.offset
+
+
+class SpillStore:
+    """
+    Queued lines that don't fit into the memory budget, one append-only file per queue group.
+    A record is the priority digit followed by the line, lines always end with "\\r\\n".
+
+    with_ns - Whether lines of the agent have the ns field. Files spilled with another value are converted with
+              reformat(line, with_ns), lines it returns None for are dropped.
+    """
+
+    def __init__(self, directory: str, limit: int, with_ns: bool = False, reformat=None):
+        self.directory = directory
+        self.limit = limit
+        self.groups = {}
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for file_name in os.listdir(directory):
+                if file_name.endswith(SPILL_SUFFIX):
+                    group = unquote(file_name[:-len(SPILL_SUFFIX)])
+                    self.groups[group] = SpilledGroup(os.path.join(directory, file_name))
+        except OSError as reason:
+            logger.error(f"Spill directory {directory} is not available. {str(reason)}")
+
+        self._check_format(with_ns, reformat)
+
+        if self.size():
+            logger.info(f"Found {self.size()} bytes of spilled items in {directory}")
+
+    def _check_format(self, with_ns: bool, reformat) -> None:
+        path = os.path.join(self.directory, FORMAT_FILE)
+        try:
+            with open(path) as format_file:
+                spilled_with_ns = format_file.read().strip() == "1"
+        except OSError:
+            # unknown, every line is checked
+            spilled_with_ns = None
+
+        if spilled_with_ns == with_ns:
+            return
+
+        if reformat:
+            for group in list(self.groups):
+                self._reformat(group, lambda line: reformat(line, with_ns))
+
+        try:
+            with open(path, "w") as format_file:
+                format_file.write("1" if with_ns else "0")
+        except OSError as reason:
+            logger.error(f"Failed to save {path}. {str(reason)}")
+
+    def _reformat(self, group: str, reformat) -> None:
+        spilled = self.groups[group]
+        dropped = 0
+        try:
+            with open(spilled.path, "rb") as spill_file, open(f"{spilled.path}.tmp", "wb") as converted_file:
+                for record in spill_file:
+                    record = record.decode("utf-8")
+                    line = reformat(record[1:])
+                    if line is None:
+                        dropped += 1
+                    else:
+                        converted_file.write(f"{record[0]}{line}".encode("utf-8"))
+            os.replace(f"{spilled.path}.tmp", spilled.path)
+        except (OSError, ValueError) as reason:
+            logger.error(f"Failed to convert spilled items in {spilled.path}. {str(reason)}")
+            self._remove(group)
+            return
+
+        self.groups[group] = SpilledGroup(spilled.path)
+        if dropped:
+            logger.warning(f"{dropped} spilled items in {spilled.path} can't be converted for with_ns, dropped them")
+
+    def size(self) -> int:
+        return sum([spilled.unread for spilled in self.groups.values()])
+
+    def has_room(self) -> bool:
+        return self.size() < self.limit
+
+    def spill(self, group: str, portion: list) -> bool:
+        """
+        Append (priority, line) pairs to the file of the group. Returns False if they were not saved.
+        """
+        spilled = self.groups.get(group)
+        if spilled is None:
+            spilled = SpilledGroup(os.path.join(self.directory, quote(group, safe="") + SPILL_SUFFIX))
+
+        data = "".join([f"{priority}{line}" for priority, line in portion]).encode("utf-8")
+        try:
+            with open(spilled.path, "ab") as spill_file:
+                spill_file.write(data)
+        except OSError as reason:
+            logger.error(f"Failed to spill items to {spilled.path}. {str(reason)}")
+            return False
+
+        spilled.size += len(data)
+        self.groups[group] = spilled
+        return True
+
+    def restore(self, group: str, max_size: int) -> list:
+        """
+        Read back the oldest spilled lines of the group, until they take max_size bytes of memory (see line_size)
+        """
+        spilled = self.groups.get(group)
+        if spilled is None:
+            return []
+
+        portion = []
+        try:
+            with open(spilled.path, "rb") as spill_file:
+                spill_file.seek(spilled.offset)
+                read = restored = 0
+                while restored < max_size:
+                    record = spill_file.readline()
+                    if not record:
+                        break
+                    read += len(record)
+                    record = record.decode("utf-8")
+                    portion.append((int(record[0]), record[1:]))
+                    restored += line_size(record[1:])
+        except (OSError, ValueError, IndexError) as reason:
+            logger.error(f"Failed to restore spilled items from {spilled.path}. {str(reason)}")
+            self._remove(group)
+            return portion
+
+        spilled.offset += read
+        if spilled.unread <= 0:
+            self._remove(group)
+
+        return portion
+
+    def groups_to_restore(self) -> list:
+        return [group for group, spilled in self.groups.items() if spilled.unread > 0]
+
+    def compact(self) -> None:
+        """
+        Drop already restored records, so they are not restored again after restart
+        """
+        for group, spilled in list(self.groups.items()):
+            if not spilled.offset:
+                continue
+            try:
+                with open(spilled.path, "rb") as spill_file:
+                    spill_file.seek(spilled.offset)
+                    data = spill_file.read()
+                with open(f"{spilled.path}.tmp", "wb") as spill_file:
+                    spill_file.write(data)
+                os.replace(f"{spilled.path}.tmp", spilled.path)
+            except OSError as reason:
+                logger.error(f"Failed to compact {spilled.path}. {str(reason)}")
+            else:
+                self.groups[group] = SpilledGroup(spilled.path)
+
+    def _remove(self, group: str) -> None:
+        spilled = self.groups.pop(group)
+        try:
+            os.remove(spilled.path)
+        except OSError as reason:
+            logger.error(f"Failed to remove {spilled.path}. {str(reason)}")
@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+import pickle
+import resource
+import signal
+import time
+from threading import Lock
+
+from pyzender.modules.base import Module
+
+logger = logging.getLogger()
+
+
+class PipeReportQueue:
+    """
+    Replacement for Agent.report_queue inside a worker process.
+    Every report is pickled and written to the pipe, the agent unpickles it on the other side.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = Lock()
+
+    def append(self, report) -> None:
+        payload = pickle.dumps(report, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.connection.send_bytes(payload)
+
+
+class WorkerAgent:
+    """
+    The part of the agent that is visible to a module running in a worker process
+    """
+
+    def __init__(self, connection):
+        self.report_queue = PipeReportQueue(connection)
+
+
+def run_module(
+        connection,
+        module_class: type,
+        kwargs: dict,
+        hostname: str,
+        config: dict,
+        memory_limit: int = 0,
+        cpu_time_limit: int = 0,
+) -> None:
+    """
+    Entry point of a worker process. The module is created again from its class and arguments,
+    nothing of the running agent (threads, locks, queues) gets into the worker.
+    """
+    # the worker must simply die on SIGTERM, the agent restarts it
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if cpu_time_limit:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time_limit, cpu_time_limit))
+
+    module = module_class(**kwargs)
+    module.hostname = hostname
+    module.config = config
+    module.run(agent=WorkerAgent(connection))
+    # Module threads live until the pipe is closed by the agent
+    module.data_thread.join()
+    module.discovery_thread.join()
+
+
+class ModuleWorker:
+    """
+    Runs a module in a child process and passes its reports back to the agent.
+
+    memory_limit - Address space limit of the worker process in bytes (0 - unlimited)
+    cpu_time_limit - CPU time limit of the worker process in seconds (0 - unlimited).
+                     The worker is killed by the kernel when it is reached and restarted by the agent.
+    """
+    restart_delay = 10
+
+    def __init__(self, module: Module, memory_limit: int = 0, cpu_time_limit: int = 0):
+        self.module = module
+        self.memory_limit = int(memory_limit)
+        self.cpu_time_limit = int(cpu_time_limit)
+        self.process = None
+        self.connection = None
+        self.restarts = 0
+        self.died_at = 0
+
+    @property
+    def name(self) -> str:
+        return self.module.name
+
+    def start(self) -> None:
+        # "spawn" instead of "fork": the agent is multithreaded, a lock held by another thread at fork time
+        # (e.g. the import lock) would stay locked in the child forever
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        self.process = context.Process(
+            name=f"WORKER: {self.name}",
+            target=run_module,
+            args=(
+                sender,
+                type(self.module),
+                self.module.init_kwargs,
+                self.module.hostname,
+                dict(self.module.config),
+                self.memory_limit,
+                self.cpu_time_limit,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        sender.close()
+        self.connection = receiver
+        logger.info(f"'{self.name}' module started in a worker process with PID: {self.process.pid}")
+
+    def stop(self) -> None:
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def collect(self, report_queue: list) -> None:
+        """
+        Move all reports that are waiting in the pipe to the agent's report queue
+        """
+        if not self.connection:
+            return
+
+        try:
+            while self.connection.poll():
+                report_queue.append(pickle.loads(self.connection.recv_bytes()))
+        except (EOFError, OSError, pickle.UnpicklingError) as reason:
+            logger.error(f"Lost connection with '{self.name}' worker process. {str(reason)}")
+            self.stop()
+
+    def supervise(self) -> None:
+        """
+        Restart the worker process if it has died
+        """
+        if self.is_alive():
+            return
+
+        if not self.died_at:
+            self.died_at = time.monotonic()
+            exitcode = self.process.exitcode if self.process else None
+            logger.error(f"Worker process of '{self.name}' module has died with exit code: {exitcode}")
+            self.stop()
+
+        if time.monotonic() - self.died_at >= self.restart_delay:
+            self.restarts += 1
+            self.died_at = 0
+            logger.info(f"Restarting '{self.name}' worker process (restart #{self.restarts})")
+            self.start()